@@ -114,6 +114,35 @@ class Vagrant(Driver):
         Molecule does not merge lists, when overriding the developer must
         provide all options.
 
+    Unless ``ssh_connection_options`` sets a ``ControlPath``, an ssh control
+    master is started to each instance once created, with its socket in the
+    ``ssh`` directory of the scenario ephemeral directory, and Ansible and
+    ``molecule login`` go through it instead of opening a new connection each
+    time.  The masters close after ``ssh_control_persist`` without
+    connections, or when the instances are destroyed.
+
+    .. code-block:: yaml
+
+        driver:
+          name: vagrant
+          provider:
+            ssh_control_master: true
+            ssh_control_persist: 30m
+
+    Give each instance its own Vagrantfile and ``.vagrant`` directory, in
+    ``vagrant-shards/<instance>`` of the scenario ephemeral directory, so that
+    Vagrant commands only load the instance they work on and instances are
+    driven concurrently (see ``max_workers``).  The instances still share
+    one instance config file.
+
+    .. code-block:: yaml
+
+        driver:
+          name: vagrant
+          provider:
+            layout: sharded
+            max_workers: 4
+
     Provide a list of files Molecule will preserve, relative to the scenario
     ephemeral directory, after any ``destroy`` subcommand execution.
 
@@ -130,6 +159,7 @@ class Vagrant(Driver):
     def __init__(self, config=None):
         super(Vagrant, self).__init__(config)
         self._name = "vagrant"
+        self._instance_config_cache = (None, {})
 
     @property
     def name(self):
@@ -155,15 +185,36 @@ class Vagrant(Driver):
             "-l {{user}} "
             "-p {{port}} "
             "-i {{identity_file}} "
+            "{{ssh_control_options}} "
             "{}"
         ).format(connection_options)
 
     @property
     def default_safe_files(self):
-        return [
-            self.vagrantfile,
+        if self.layout == "sharded":
+            vagrant_files = [os.path.join(self.shards_directory, "*")]
+        else:
+            vagrant_files = [
+                self.vagrantfile,
+                self.vagrantfile + ".sha256",
+                # NOTE: Molecule matches each file with fnmatch, the files
+                # inside directories have to be matched by a pattern.
+                os.path.join(
+                    self._config.scenario.ephemeral_directory, ".vagrant", "*"
+                ),
+            ]
+        return vagrant_files + [
             self.instance_config,
-            os.path.join(self._config.scenario.ephemeral_directory, ".vagrant"),
+            os.path.join(
+                self._config.scenario.ephemeral_directory, "vagrant-snapshots.json"
+            ),
+            os.path.join(
+                self._config.scenario.ephemeral_directory, "vagrant-instances.json"
+            ),
+            os.path.join(self.ssh_control_directory, "*"),
+            os.path.join(
+                self._config.scenario.ephemeral_directory, "vagrantfile-cache", "*"
+            ),
             os.path.join(self._config.scenario.ephemeral_directory, "vagrant-*.out"),
             os.path.join(self._config.scenario.ephemeral_directory, "vagrant-*.err"),
         ]
@@ -173,9 +224,12 @@ class Vagrant(Driver):
         return self._get_ssh_connection_options()
 
     def login_options(self, instance_name):
-        d = {"instance": instance_name}
+        d = util.merge_dicts(
+            {"instance": instance_name}, self._get_instance_config(instance_name)
+        )
+        d["ssh_control_options"] = " ".join(self._get_ssh_control_options(d))
 
-        return util.merge_dicts(d, self._get_instance_config(instance_name))
+        return d
 
     def ansible_connection_options(self, instance_name):
         try:
@@ -187,7 +241,11 @@ class Vagrant(Driver):
                 "ansible_port": d["port"],
                 "ansible_private_key_file": d["identity_file"],
                 "connection": "ssh",
-                "ansible_ssh_common_args": " ".join(self.ssh_connection_options),
+                # NOTE: ssh keeps the first value given for an option, the
+                # control options come first to win over the defaults.
+                "ansible_ssh_common_args": " ".join(
+                    self._get_ssh_control_options(d) + self.ssh_connection_options
+                ),
             }
         except StopIteration:
             return {}
@@ -196,16 +254,86 @@ class Vagrant(Driver):
             # instance_config is not on disk.
             return {}
 
+    @property
+    def layout(self):
+        return self._get_option("layout", "single")
+
+    @property
+    def shards_directory(self):
+        return os.path.join(self._config.scenario.ephemeral_directory, "vagrant-shards")
+
     @property
     def vagrantfile(self):
         return os.path.join(self._config.scenario.ephemeral_directory, "Vagrantfile")
 
-    def _get_instance_config(self, instance_name):
-        instance_config_dict = util.safe_load_file(self._config.driver.instance_config)
+    @property
+    def ssh_control_directory(self):
+        from molecule_vagrant.modules.vagrant import SSH_CONTROL_DIR
+
+        return os.path.join(self._config.scenario.ephemeral_directory, SSH_CONTROL_DIR)
+
+    def _get_ssh_control_options(self, instance_config):
+        """Return the ssh options going through the instance's control master.
 
-        return next(
-            item for item in instance_config_dict if item["instance"] == instance_name
+        The control directory is created here, scenarios with their own
+        create playbook never having the module start the masters in it.
+        """
+        from molecule_vagrant.modules.vagrant import (
+            SSH_CONTROL_PATH,
+            SSH_CONTROL_PATH_MAX,
+        )
+
+        if not self._get_option("ssh_control_master", True) or any(
+            "ControlPath" in o for o in self.ssh_connection_options
+        ):
+            return []
+        socket = os.path.join(
+            self.ssh_control_directory,
+            "{address}-{port}-{user}".format(**instance_config),
         )
+        if len(socket) > SSH_CONTROL_PATH_MAX:
+            return []
+        try:
+            os.makedirs(self.ssh_control_directory, mode=0o700, exist_ok=True)
+        except OSError:
+            return []
+
+        return [
+            "-o ControlMaster=auto",
+            "-o ControlPath={}".format(
+                os.path.join(self.ssh_control_directory, SSH_CONTROL_PATH)
+            ),
+            "-o ControlPersist={}".format(
+                self._get_option("ssh_control_persist", "30m")
+            ),
+        ]
+
+    def _get_option(self, name, default):
+        """Return an option of the driver, set under driver.provider.
+
+        Molecule 4 refuses unknown keys directly under driver, provider being
+        the only mapping open to them.
+        """
+        provider = self._config.config["driver"].get("provider") or {}
+        return provider.get(name, default)
+
+    def _get_instance_config(self, instance_name):
+        # NOTE: Molecule asks for the config of every host in turn, so the
+        # file is parsed once and indexed by instance until it changes.
+        instance_config = self._config.driver.instance_config
+        st = os.stat(instance_config)
+        key = (instance_config, st.st_mtime_ns, st.st_size)
+        if self._instance_config_cache[0] != key:
+            instance_config_dict = util.safe_load_file(instance_config) or []
+            self._instance_config_cache = (
+                key,
+                dict((item["instance"], item) for item in instance_config_dict),
+            )
+
+        try:
+            return self._instance_config_cache[1][instance_name]
+        except KeyError:
+            raise StopIteration
 
     def sanity_checks(self):
         if not which("vagrant"):
@@ -28,14 +28,17 @@ __metaclass__ = type
 
 from ansible.module_utils.basic import AnsibleModule
 import contextlib
+import copy
 import datetime
+import hashlib
 import io
+import json
 import os
+import re
 import subprocess
 import sys
-
-import molecule
-import molecule.util
+import threading
+import time
 
 try:
     import vagrant
@@ -139,14 +142,20 @@ options:
     default: None
   force_stop:
     description:
-      - Force halt the instance, then destroy the instance.
+      - Force halt the instance, then destroy the instance. The separate halt
+        is skipped for providers whose destroy already powers off the
+        instance (libvirt, parallels, virtualbox and vmware_desktop).
     required: False
     default: False
   state:
     description:
-      - The desired state of the instance.
+      - The desired state of the instance. With up, suspended instances are
+        resumed instead of booted, and created instances whose config changed
+        since the last up are reloaded, or recreated when their box or
+        provider changed.
     required: True
-    choices: ['up', 'halt', 'destroy']
+    choices: ['up', 'halt', 'destroy', 'suspend', 'resume', 'snapshot', 'restore',
+              'package']
     default: None
   workdir:
     description:
@@ -170,18 +179,224 @@ options:
         setting VAGRANT_NO_PARALLEL environment variable.
     required: False
     default: True
+  max_workers:
+    description:
+      - When greater than 1, start, halt and destroy the instances concurrently
+        from a pool of that many workers, each instance logging into its own
+        vagrant-<instance>.out/err files. Useful for providers where Vagrant
+        handles the machines serially, like virtualbox.
+    required: False
+    default: 1
+  layout:
+    description:
+      - How the instances are laid out in workdir. With single, all the
+        instances are defined in one Vagrantfile. With sharded, each instance
+        gets its own Vagrantfile and .vagrant directory in
+        vagrant-shards/<instance>, so that Vagrant only loads the instance
+        it works on, and the instances are driven concurrently from the
+        max_workers pool.
+    required: False
+    choices: ['single', 'sharded']
+    default: single
+  log_max_size:
+    description:
+      - Size in bytes from which the vagrant log files are rotated, keeping
+        one previous generation. Errors only report the log written by the
+        current run, from the offset each log had when the run opened it.
+    required: False
+    default: 10485760
+  stream:
+    description:
+      - Follow the output of `vagrant up` while it runs. Besides being
+        written to the log file, box download percentages and boot phases of
+        each instance are appended as JSON lines to vagrant.progress in the
+        working directory as soon as they happen, boot phases being sent to
+        the module log too. vagrant.progress is rotated like the logs, see
+        log_max_size.
+    required: False
+    default: False
+  timings_file:
+    description:
+      - Also write the timings returned by the module as JSON into
+        timings.json, next to the Vagrantfile.
+    required: False
+    default: False
+  prefetch_boxes:
+    description:
+      - Before starting instances, add the distinct boxes they use which are
+        missing, concurrently. Boxes found present are recorded in
+        molecule-vagrant-boxes.json under VAGRANT_HOME so that later runs
+        don't have to list the boxes again.
+    required: False
+    default: False
+  instance_config:
+    description:
+      - Path of the Molecule instance_config file to maintain with state=up.
+        It is written atomically, with mode 0600, when instances are started
+        or when it doesn't describe all of them.
+    required: False
+    default: None
+  snapshot_name:
+    description:
+      - Name of the snapshot taken by state=snapshot and rolled back to by
+        state=restore. Instances which already have it are left alone by
+        state=snapshot, instances which don't are destroyed by state=restore.
+        Snapshots taken are recorded in vagrant-snapshots.json in the
+        working directory.
+    required: False
+    default: molecule
+  admission:
+    description:
+      - Start the instances in waves fitting the memory available on the
+        host (read from /proc/meminfo) and its CPUs, instead of all at once.
+    required: False
+    default: False
+  admission_memory_headroom:
+    description:
+      - Memory in MiB to keep available on the host when admitting
+        instances.
+    required: False
+    default: 1024
+  admission_cpu_ratio:
+    description:
+      - CPUs of the instances started together per host CPU.
+    required: False
+    default: 1.0
+  boot_slots:
+    description:
+      - Number of instances all the module runs of the host may start at the
+        same time, 0 meaning no limit. Each instance starting holds a slot,
+        a file locked in boot_slots_dir, which is given back when it is up
+        or when the module dies.
+    required: False
+    default: 0
+  boot_slots_dir:
+    description:
+      - Directory of the boot slot files, shared by the module runs using
+        the same slots.
+    required: False
+    default: molecule-boot-slots under VAGRANT_HOME
+  boot_slots_timeout:
+    description:
+      - Seconds to wait for boot slots before failing.
+    required: False
+    default: 3600
+  prepared_boxes:
+    description:
+      - Create the instances from the box prepared from their box, box
+        version, provider and prepare_playbook when there is one. state=package
+        makes the prepared boxes missing out of running instances. They are
+        stored in molecule-prepared-boxes under VAGRANT_HOME.
+    required: False
+    default: False
+  prepared_boxes_budget:
+    description:
+      - Size in bytes the prepared boxes may use. state=package removes the
+        least recently used ones beyond it.
+    required: False
+    default: 10737418240
+  prepare_playbook:
+    description:
+      - Playbook preparing the instances, part of what identifies their
+        prepared box.
+    required: False
+    default: None
+  ssh_control_master:
+    description:
+      - Keep an ssh control master open to each instance once up, with its
+        socket in the ssh directory of workdir, for Ansible to reuse instead
+        of opening a connection per task. The masters are closed when the
+        instances are halted, suspended, restored or destroyed.
+    required: False
+    default: False
+  ssh_control_persist:
+    description:
+      - How long an ssh control master stays open without connections, in
+        the ControlPersist format of ssh.
+    required: False
+    default: 30m
 
 requirements:
     - python >= 2.6
+    - jinja2
     - python-vagrant
     - vagrant
 """
 
+# NOTE: Vagrant output lines reporting progress, e.g.
+#   ==> instance: Booting VM...
+#       instance: Progress: 42% (Rate: 10.1M/s, Estimated time remaining: 0:01:02)
+PHASE_RE = re.compile(r"^==> (?P<machine>[^:\s]+): (?P<message>.*)$")
+PROGRESS_RE = re.compile(r"^\s*(?P<machine>[^:\s]+): Progress: (?P<percent>\d+)%")
+# NOTE: Any Vagrant output line about a single machine, prefixed by its name.
+MACHINE_LINE_RE = re.compile(r"^(?:==> |\s+)(?P<machine>[^:\s]+): ")
+
+# NOTE: Boxes prefetched concurrently and index of the boxes known to be
+# present, stored in VAGRANT_HOME.
+PREFETCH_WORKERS = 4
+BOX_INDEX = "molecule-vagrant-boxes.json"
+
+# NOTE: Directory of the boot slot files under VAGRANT_HOME, and seconds
+# between two attempts to take slots.
+BOOT_SLOTS_DIR = "molecule-boot-slots"
+BOOT_SLOT_POLL = 1
+
+# NOTE: Directory of the prepared boxes under VAGRANT_HOME, and index of
+# them stored there.
+PREPARED_BOXES_DIR = "molecule-prepared-boxes"
+PREPARED_BOXES_INDEX = "index.json"
+
+# NOTE: Directory of the instance directories of the sharded layout, under
+# workdir.
+SHARDS_DIR = "vagrant-shards"
+
+# NOTE: Directory of the ssh control sockets under workdir, and name of the
+# sockets. Unix socket paths are limited to 104 bytes on some platforms, and
+# ssh binds a temporary name 17 bytes longer before renaming it.
+SSH_CONTROL_DIR = "ssh"
+SSH_CONTROL_PATH = "%h-%p-%r"
+SSH_CONTROL_PATH_MAX = 104 - 17
+SSH_OPTIONS = [
+    "-o",
+    "UserKnownHostsFile=/dev/null",
+    "-o",
+    "StrictHostKeyChecking=no",
+    "-o",
+    "IdentitiesOnly=yes",
+    "-o",
+    "LogLevel=ERROR",
+    "-o",
+    "BatchMode=yes",
+    "-o",
+    "ConnectTimeout=30",
+]
+SSH_MASTER_WORKERS = 8
+
+# NOTE: Keys of the instance_config entries, as read by the Molecule driver.
+INSTANCE_CONFIG_KEYS = ["instance", "address", "user", "port", "identity_file"]
+
+# NOTE: States of a suspended machine, depending on the provider.
+SUSPENDED_STATES = ["saved", "paused", "suspended"]
+
+# NOTE: Config keys of the box of an instance, and those which can't change
+# without recreating it.
+BOX_KEYS = [
+    "box",
+    "box_version",
+    "box_url",
+    "box_download_checksum",
+    "box_download_checksum_type",
+]
+RECREATE_KEYS = BOX_KEYS + ["provider"]
+
+# NOTE: Providers whose destroy action already powers off a running machine.
+DESTROY_HALTS_PROVIDERS = ["libvirt", "parallels", "virtualbox", "vmware_desktop"]
+
 EXAMPLES = """
 See doc/source/configuration.rst
 """
 
-VAGRANTFILE_TEMPLATE = """
+VAGRANTFILE_MACROS = """
 {%- macro ruby_format(value) -%}
   {%- if value is boolean -%}
     {{ value | string | lower }}
@@ -203,17 +418,11 @@ VAGRANTFILE_TEMPLATE = """
     {{ sep() }}{{ key }}: {{ ruby_format(value) }}
   {%- endfor -%}
 {%- endmacro -%}
+""".strip()  # noqa
 
-Vagrant.configure('2') do |config|
-  if Vagrant.has_plugin?('vagrant-cachier')
-    {% if cachier is not none and cachier in [ "machine", "box" ] %}
-    config.cache.scope = '{{ cachier }}'
-    {% else %}
-    config.cache.disable!
-    {% endif %}
-  end
-
-{% for instance in instances %}
+# NOTE: Rendered on its own for each instance, the Vagrantfile being
+# assembled from the resulting blocks.
+VAGRANTFILE_INSTANCE_TEMPLATE = """{% from "macros" import ruby_format, dict2args %}
   config.vm.define "{{ instance.name }}" do |c|
     ##
     # Box definition
@@ -316,7 +525,19 @@ Vagrant.configure('2') do |config|
       {% endif %}
     end
   end
-{% endfor %}
+"""  # noqa
+
+VAGRANTFILE_TEMPLATE = """
+Vagrant.configure('2') do |config|
+  if Vagrant.has_plugin?('vagrant-cachier')
+    {% if cachier is not none and cachier in [ "machine", "box" ] %}
+    config.cache.scope = '{{ cachier }}'
+    {% else %}
+    config.cache.disable!
+    {% endif %}
+  end
+
+{% for block in instance_blocks %}{{ block }}{% endfor %}
 end
 """.strip()  # noqa
 
@@ -337,8 +558,252 @@ stderr:
     description: Output on stderr
     returned: changed
     type: str
+progress:
+    description: Progress events file, when stream is enabled
+    returned: success
+    type: str
+logs:
+    description: Log file of each instance, when max_workers is greater than 1
+      or with the sharded layout
+    returned: success
+    type: dict
+timings:
+    description: Time spent in each phase (write_vagrantfile, validate,
+      status, up, conf, halt, destroy) and by each Vagrant process, with its
+      phase and command, along with the number of Vagrant processes started
+      and the bytes written to the logs
+    returned: success
+    type: dict
+admission:
+    description: Host CPUs admitted and, for each wave of instances started
+      together, its instances, memory, CPUs, the memory available on the host
+      (MiB) before it started, and whether it was forced for not fitting,
+      when admission is enabled and instances had to be started
+    returned: state is up
+    type: dict
+ssh_masters:
+    description: Instances whose ssh control master was started, and those
+      for which it failed, when ssh_control_master is enabled
+    returned: state is up
+    type: dict
+boot_slots:
+    description: Instances started under boot slots and seconds they waited
+      for them, when boot_slots is set and instances had to be started
+    returned: state is up
+    type: list
+prefetch:
+    description: Boxes found present, added or which failed to be added, when
+      prefetch_boxes is enabled and instances had to be started
+    returned: state is up
+    type: dict
+outcomes:
+    description: Outcome of up for each instance, already_running, reloaded,
+      started, resumed or failed, failed instances coming with the stderr of
+      their Vagrant run, without the lines about the other instances when
+      they shared it
+    returned: state is up
+    type: list
+changes:
+    description: Created instances whose config changed since their last up,
+      with the config keys changed and what applied them, reload, recreate
+      or up when the instance was stopped
+    returned: state is up
+    type: list
+suspended:
+    description: Instances suspended
+    returned: state is suspend
+    type: list
+resumed:
+    description: Instances resumed
+    returned: state is resume
+    type: list
+prepared:
+    description: Instances packaged or which failed to be, and prepared boxes
+      evicted
+    returned: state is package
+    type: dict
+snapshots:
+    description: Instances whose snapshot was taken
+    returned: state is snapshot
+    type: list
+restored:
+    description: Instances rolled back to their snapshot
+    returned: state is restore
+    type: list
+destroyed:
+    description: Instances destroyed for lack of a snapshot
+    returned: state is restore
+    type: list
+fragments:
+    description: Number of instance blocks of the Vagrantfile rendered and
+      reused from the previous runs, when the Vagrantfile was written
+    returned: success
+    type: dict
+cache:
+    description: Hits and misses of the status/ssh-config cache, each miss
+      being a lookup that had to query Vagrant or the provider
+    returned: success
+    type: dict
 """
 
+MOLECULE_HEADER = "# Molecule managed"
+
+
+# NOTE: The helpers below mirror the molecule.util ones. The module runs in
+# its own Python process for every task, importing Molecule there only for
+# them used to cost more than all the rest of the module startup.
+def write_file(filename, content, header=None):
+    """Write content to filename, prefixed by header (Molecule's default)."""
+    if header is None:
+        content = MOLECULE_HEADER + "\n\n" + content
+
+    with open(filename, "w") as f:
+        f.write(content)
+
+
+def merge_dicts(a, b):
+    """Merge the values of b into a and return a new dict.
+
+    Same algorithm as Ansible's `combine(recursive=True)` filter.
+    """
+    result = copy.deepcopy(a)
+
+    for k, v in b.items():
+        if k in a and isinstance(a[k], dict) and isinstance(v, dict):
+            result[k] = merge_dicts(a[k], v)
+        else:
+            result[k] = v
+
+    return result
+
+
+class BootSlotTimeout(Exception):
+    """Raised when no boot slot could be taken in time."""
+
+
+class TracedVagrant(vagrant.Vagrant):
+    """A python-vagrant client telling on_command the commands it runs.
+
+    python-vagrant enters the stderr context manager of a command without
+    its arguments, on_command gets them just before, in the same thread.
+    """
+
+    def __init__(self, on_command, **kwargs):
+        super(TracedVagrant, self).__init__(**kwargs)
+        self._on_command = on_command
+
+    def _make_vagrant_command(self, args):
+        self._on_command(args)
+        return super(TracedVagrant, self)._make_vagrant_command(args)
+
+
+class VagrantfileRenderer(object):
+    """Render Vagrantfiles, reusing the work of the previous runs.
+
+    The templates are compiled once into a bytecode cache, and the block of
+    each instance is stored along with a digest of what it is rendered from,
+    so that only the instances whose configuration changed are rendered
+    again.
+    """
+
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        self._env = None
+        self._template_digest = hashlib.sha256(
+            (VAGRANTFILE_MACROS + VAGRANTFILE_INSTANCE_TEMPLATE).encode("utf-8")
+        ).hexdigest()
+        self.stats = {"rendered": 0, "reused": 0}
+        self._fragments = None
+        self._rendered = {}
+
+    def render(self, instances, cachier, no_kvm, save=True):
+        """Return the Vagrantfile of instances.
+
+        The fragment cache is saved unless save is False, for several
+        renders to save it once, see save().
+        """
+        if self._fragments is None:
+            self._fragments = self._read_fragments()
+        fragments = self._fragments
+        rendered = self._rendered
+        blocks = []
+        for instance in instances:
+            key = self._get_fragment_key(instance, no_kvm)
+            if key in fragments:
+                self.stats["reused"] += 1
+                rendered[key] = fragments[key]
+            elif key not in rendered:
+                self.stats["rendered"] += 1
+                rendered[key] = (
+                    self._get_env()
+                    .get_template("instance")
+                    .render(instance=instance, no_kvm=no_kvm)
+                )
+            blocks.append(rendered[key])
+        if save:
+            self.save()
+
+        return (
+            self._get_env()
+            .get_template("vagrantfile")
+            .render(cachier=cachier, instance_blocks=blocks)
+        )
+
+    def save(self):
+        """Save the blocks of every render of this renderer to the cache."""
+        self._write_fragments(self._rendered)
+
+    def _get_env(self):
+        if self._env is None:
+            import jinja2
+
+            bytecode_dir = os.path.join(self._cache_dir, "bytecode")
+            os.makedirs(bytecode_dir, exist_ok=True)
+            self._env = jinja2.Environment(
+                loader=jinja2.DictLoader(
+                    {
+                        "macros": VAGRANTFILE_MACROS,
+                        "instance": VAGRANTFILE_INSTANCE_TEMPLATE,
+                        "vagrantfile": VAGRANTFILE_TEMPLATE,
+                    }
+                ),
+                bytecode_cache=jinja2.FileSystemBytecodeCache(bytecode_dir),
+                keep_trailing_newline=True,
+            )
+        return self._env
+
+    def _get_fragment_key(self, instance, no_kvm):
+        data = json.dumps(
+            {
+                "instance": instance,
+                "no_kvm": no_kvm,
+                "template": self._template_digest,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _read_fragments(self):
+        try:
+            with io.open(
+                os.path.join(self._cache_dir, "fragments.json"), "r", encoding="utf-8"
+            ) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_fragments(self, fragments):
+        # NOTE: Only the blocks rendered by this renderer are kept.
+        path = os.path.join(self._cache_dir, "fragments.json")
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump(fragments, f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
+
 
 class VagrantClient(object):
     def __init__(self, module):
@@ -382,32 +847,65 @@ class VagrantClient(object):
         else:
             self.instances = self._module.params["instances"]
 
+        # NOTE: Every status or ssh-config lookup costs a Vagrant (Ruby)
+        # process, so results are kept for the whole module run and only
+        # dropped by the lifecycle actions which change them.
+        self._cache = {}
+        self._cache_stats = {"hits": 0, "misses": 0}
+
+        self._workers = self._module.params["max_workers"]
+        self._sharded = self._module.params["layout"] == "sharded"
+        self._instance_vagrants = {}
+        self._prepare_playbook = None
+        self._prepared_keys = {}
+        self._base_boxes = {}
+        self._log_offsets = {}
+        self._progress_lock = threading.Lock()
+
+        self._start = time.monotonic()
+        # NOTE: The phase and the Vagrant command being timed are those of
+        # each thread, instances being driven from a worker pool.
+        self._local = threading.local()
+        self._timings_lock = threading.Lock()
+        self._timings = {"phases": {}, "commands": [], "processes": 0}
+
+        self._has_error = None
+        self._datetime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.result = {}
+
         self._config = self._get_config()
         self._vagrantfile = self._config["vagrantfile"]
         self._vagrant = self._get_vagrant()
         self._write_configs()
-        self._has_error = None
-        self._datetime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.result = {}
 
     @contextlib.contextmanager
     def stdout_cm(self):
         """Redirect the stdout to a log file."""
-        with open(self._get_stdout_log(), "a+") as fh:
-            msg = "### {} ###\n".format(self._datetime)
-            fh.write(msg)
-            fh.flush()
-
+        with self._open_log(self._get_stdout_log()) as fh:
             yield fh
 
+    def _log_cm(self, filename, command=False):
+        """Return a context manager factory appending to filename.
+
+        python-vagrant enters its stderr context manager once per Vagrant
+        process, command makes this one time the process.
+        """
+
+        @contextlib.contextmanager
+        def cm():
+            with self._open_log(filename) as fh:
+                if not command:
+                    yield fh
+                    return
+                with self._timed_command():
+                    yield fh
+
+        return cm
+
     @contextlib.contextmanager
     def stderr_cm(self):
         """Redirect the stderr to a log file."""
-        with open(self._get_stderr_log(), "a+") as fh:
-            msg = "### {} ###\n".format(self._datetime)
-            fh.write(msg)
-            fh.flush()
-
+        with self._open_log(self._get_stderr_log()) as fh, self._timed_command():
             try:
                 yield fh
             except subprocess.CalledProcessError as e:
@@ -432,113 +930,1518 @@ class VagrantClient(object):
 
     def up(self):
         changed = False
-        if self._running() != len(self.instances):
+        status = self._status()
+        changes = self._get_config_changes(status)
+        recreated = [c["name"] for c in changes if c["action"] == "recreate"]
+        reloaded = [c["name"] for c in changes if c["action"] == "reload"]
+        if recreated:
             changed = True
-            provision = self.provision
-            try:
-                self._vagrant.up(provision=provision)
-            except Exception:
-                # NOTE(retr0h): Ignore the exception since python-vagrant
-                # passes the actual error as a no-argument ContextManager.
-                pass
+            self._destroy(recreated)
+        if reloaded:
+            changed = True
+            self._run_lifecycle("reload", reloaded)
+        if recreated or reloaded:
+            status = self._status()
+        outcomes = dict(
+            (
+                i["name"],
+                {
+                    "name": i["name"],
+                    "outcome": "reloaded"
+                    if i["name"] in reloaded
+                    else "already_running",
+                },
+            )
+            for i in self.instances
+        )
+        vm_names = [
+            i["name"]
+            for i in self.instances
+            if status.get(i["name"], {}).get("state") != "running"
+        ]
+        # NOTE: Suspended machines are resumed rather than booted.
+        suspended = [
+            n for n in vm_names if status.get(n, {}).get("state") in SUSPENDED_STATES
+        ]
+        if vm_names:
+            changed = True
+            if self._module.params["prefetch_boxes"]:
+                with self._timed("prefetch"):
+                    self.result["prefetch"] = self._prefetch_boxes(vm_names)
+            with self._timed("up"):
+                stderr = {}
+                for wave in self._admit(vm_names):
+                    for names in self._split_for_boot_slots(wave):
+                        stderr.update(self._start_instances(names, suspended))
+            self._invalidate_cache()
+
+            status = self._status()
+            for name in vm_names:
+                if status.get(name, {}).get("state") == "running":
+                    outcomes[name]["outcome"] = (
+                        "resumed" if name in suspended else "started"
+                    )
+                else:
+                    self._has_error = True
+                    outcomes[name]["outcome"] = "failed"
+                    outcomes[name]["stderr"] = stderr[name]
+        self.result["outcomes"] = list(outcomes.values())
+        self.result["changes"] = changes
 
         # NOTE(retr0h): Ansible wants only one module return `fail_json`
         # or `exit_json`.
         if not self._has_error:
             # compat
             if self._module.params["instance_name"] is not None:
-                self._module.exit_json(
-                    changed=changed, log=self._get_stdout_log(), **self._conf()[0]
+                self._exit_json(
+                    changed=changed,
+                    log=self._get_stdout_log(),
+                    outcomes=self.result["outcomes"],
+                    **self._conf()[0],
                 )
-            self._module.exit_json(
-                changed=changed, log=self._get_stdout_log(), results=self._conf()
+            self._write_instances_config()
+            results, written = self._update_instance_config(changed)
+            if self._module.params["ssh_control_master"]:
+                self.result["ssh_masters"] = self._start_ssh_masters(results)
+            self._exit_json(
+                changed=changed or written,
+                log=self._get_stdout_log(),
+                outcomes=self.result["outcomes"],
+                changes=changes,
+                ssh_masters=self.result.get("ssh_masters"),
+                prefetch=self.result.get("prefetch"),
+                admission=self.result.get("admission"),
+                boot_slots=self.result.get("boot_slots"),
+                results=results,
             )
 
-        msg = "Failed to start the VM(s): See log file '{}'".format(
-            self._get_stderr_log()
-        )
-        with io.open(self._get_stderr_log(), "r", encoding="utf-8") as f:
-            self.result["stderr"] = f.read()
-        self._module.fail_json(msg=msg, **self.result)
+        failed = [o for o in self.result["outcomes"] if o["outcome"] == "failed"]
+        names = " " + ", ".join(o["name"] for o in failed) if failed else ""
+        # NOTE: Pooled instances log to their own files, vagrant.err stays
+        # empty.
+        if self._pooled() and failed:
+            msg = "Failed to start the VM(s){}: See log files {}".format(
+                names,
+                ", ".join(
+                    "'{}'".format(self._get_vagrant_log("err", o["name"]))
+                    for o in failed
+                ),
+            )
+            self.result["stderr"] = "".join(o["stderr"] for o in failed)
+        else:
+            msg = "Failed to start the VM(s){}: See log file '{}'".format(
+                names, self._get_stderr_log()
+            )
+            self.result["stderr"] = self._read_log(self._get_stderr_log())
+        self._fail_json(msg)
 
     def destroy(self):
         changed = False
+        self._close_ssh_masters()
         if self._created() > 0:
             changed = True
-            if self._module.params["force_stop"]:
-                self._vagrant.halt(force=True)
-            self._vagrant.destroy()
+            self._destroy()
+
+        self._exit_json(changed=changed)
+
+    def snapshot(self):
+        changed = False
+        snapshot_name = self._module.params["snapshot_name"]
+        snapshots = self._read_snapshots()
+        vm_names = [
+            name
+            for name in self._get_created_names()
+            if snapshots.get(name) != snapshot_name
+        ]
+        if vm_names:
+            changed = True
+            with self._timed("snapshot"):
+                if self._pooled():
+                    self._run_parallel(self._snapshot_instance, vm_names)
+                else:
+                    offset = self._get_log_mark(self._get_stderr_log())
+                    self._vagrant_snapshot(
+                        self._vagrant,
+                        "save",
+                        vm_names if len(vm_names) < len(self.instances) else None,
+                    )
+                    self._fail_on_vagrant_error("snapshot", offset)
+            for name in vm_names:
+                if name not in self.result.get("errors", {}):
+                    snapshots[name] = snapshot_name
+            self._write_snapshots(snapshots)
+            self._fail_on_errors("snapshot")
+
+        self._exit_json(changed=changed, snapshots=vm_names)
+
+    def restore(self):
+        changed = False
+        self._close_ssh_masters()
+        snapshot_name = self._module.params["snapshot_name"]
+        snapshots = self._read_snapshots()
+        created = self._get_created_names()
+        vm_names = [name for name in created if snapshots.get(name) == snapshot_name]
+        # NOTE: Machines without a snapshot to go back to are destroyed.
+        destroyed = [name for name in created if name not in vm_names]
+        if vm_names:
+            changed = True
+            with self._timed("restore"):
+                if self._pooled():
+                    self._run_parallel(self._restore_instance, vm_names)
+                    self._fail_on_errors("restore")
+                else:
+                    offset = self._get_log_mark(self._get_stderr_log())
+                    self._vagrant_snapshot(
+                        self._vagrant,
+                        "restore",
+                        vm_names if len(vm_names) < len(self.instances) else None,
+                    )
+                    self._fail_on_vagrant_error("restore", offset)
+            self._invalidate_cache()
+        if destroyed:
+            changed = True
+            self._destroy(destroyed)
 
-        self._module.exit_json(changed=changed)
+        self._exit_json(changed=changed, restored=vm_names, destroyed=destroyed)
 
     def halt(self):
         changed = False
+        self._close_ssh_masters()
         if self._running() > 0:
             changed = True
-            self._vagrant.halt(force=self._module.params["force_stop"])
-
-        self._module.exit_json(changed=changed)
+            status = self._status()
+            with self._timed("halt"):
+                if self._pooled():
+                    self._run_parallel(
+                        self._halt_instance,
+                        [
+                            i["name"]
+                            for i in self.instances
+                            if status.get(i["name"], {}).get("state") == "running"
+                        ],
+                    )
+                    self._fail_on_errors("halt")
+                else:
+                    self._vagrant.halt(force=self._module.params["force_stop"])
+            self._invalidate_cache()
+
+        self._exit_json(changed=changed)
+
+    def _start_instances(self, instance_names, suspended):
+        """Start or resume the instances, returning their stderr."""
+        if self._pooled():
+            self._run_parallel(self._up_instance, instance_names)
+            return dict(
+                (n, self._read_log(self._get_vagrant_log("err", n)))
+                for n in instance_names
+            )
 
-    def _conf_instance(self, instance_name):
+        offset = self._get_log_mark(self._get_stderr_log())
+        resumed = [n for n in instance_names if n in suspended]
+        booted = [n for n in instance_names if n not in suspended]
         try:
-            return self._vagrant.conf(vm_name=instance_name)
+            with self._boot_slots(instance_names):
+                if resumed:
+                    self._vagrant_lifecycle(
+                        self._vagrant,
+                        "resume",
+                        resumed if len(resumed) < len(self.instances) else None,
+                    )
+                # NOTE: Let Vagrant pick all the machines by itself when none
+                # is running.
+                if booted:
+                    self._vagrant_up(
+                        self._vagrant,
+                        booted if len(booted) < len(self.instances) else None,
+                    )
+        except BootSlotTimeout as e:
+            self._fail_json(str(e))
         except Exception:
-            msg = "Failed to get vagrant config for {}: See log file '{}'".format(
-                instance_name, self._get_stderr_log()
+            # NOTE(retr0h): Ignore the exception since python-vagrant
+            # passes the actual error as a no-argument ContextManager.
+            pass
+        return self._split_log(
+            self._read_log(self._get_stderr_log(), offset), instance_names
+        )
+
+    def _split_log(self, log, instance_names):
+        """Return the part of a log shared by instances concerning each one.
+
+        Lines naming one of the instances in their ``==> name:`` prefix only
+        go to it, the lines naming none of them go to all.
+        """
+        logs = dict((n, []) for n in instance_names)
+        for line in log.splitlines(True):
+            m = MACHINE_LINE_RE.match(line)
+            if m and m.group("machine") in logs:
+                logs[m.group("machine")].append(line)
+                continue
+            for lines in logs.values():
+                lines.append(line)
+        return dict((n, "".join(lines)) for n, lines in logs.items())
+
+    def _admit(self, instance_names):
+        """Yield the instances to start together, in waves fitting the host.
+
+        The memory of each wave must fit in the memory available on the
+        host minus admission_memory_headroom, and its CPUs in the host CPUs
+        times admission_cpu_ratio. The available memory is read again
+        before each wave, once the previous one is up. An instance fitting
+        in no wave gets one of its own. Decisions are recorded in the module
+        result under ``admission``.
+        """
+        if not self._module.params["admission"]:
+            yield instance_names
+            return
+
+        cpus = (os.cpu_count() or 1) * self._module.params["admission_cpu_ratio"]
+        headroom = self._module.params["admission_memory_headroom"]
+        admission = self.result["admission"] = {"cpus": cpus, "waves": []}
+        pending = list(instance_names)
+        while pending:
+            available = self._get_memory_available()
+            wave = []
+            memory = wave_cpus = 0
+            for name in pending:
+                i = self._instances_config[name]
+                if available is None or (
+                    memory + int(i["memory"]) <= available - headroom
+                    and wave_cpus + int(i["cpus"]) <= cpus
+                ):
+                    wave.append(name)
+                    memory += int(i["memory"])
+                    wave_cpus += int(i["cpus"])
+            forced = not wave
+            if forced:
+                wave = pending[:1]
+                i = self._instances_config[wave[0]]
+                memory, wave_cpus = int(i["memory"]), int(i["cpus"])
+            pending = [name for name in pending if name not in wave]
+            admission["waves"].append(
+                {
+                    "instances": wave,
+                    "memory": memory,
+                    "cpus": wave_cpus,
+                    "memory_available": available,
+                    "forced": forced,
+                }
+            )
+            yield wave
+
+    def _get_memory_available(self):
+        """Return the memory available on the host in MiB, None if unknown."""
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) // 1024
+        except (IOError, ValueError, IndexError):
+            pass
+        return None
+
+    def suspend(self):
+        changed = False
+        self._close_ssh_masters()
+        status = self._status()
+        vm_names = [
+            i["name"]
+            for i in self.instances
+            if status.get(i["name"], {}).get("state") == "running"
+        ]
+        if vm_names:
+            changed = True
+            self._run_lifecycle("suspend", vm_names)
+
+        self._exit_json(changed=changed, suspended=vm_names)
+
+    def resume(self):
+        changed = False
+        status = self._status()
+        vm_names = [
+            i["name"]
+            for i in self.instances
+            if status.get(i["name"], {}).get("state") in SUSPENDED_STATES
+        ]
+        if vm_names:
+            changed = True
+            self._run_lifecycle("resume", vm_names)
+
+        self._exit_json(changed=changed, resumed=vm_names)
+
+    def _run_lifecycle(self, action, vm_names):
+        """Run `vagrant suspend`, `resume` or `reload` for vm_names."""
+        with self._timed(action):
+            if self._pooled():
+                self._run_parallel(
+                    lambda name: self._vagrant_lifecycle(
+                        self._get_instance_vagrant(name), action, [name]
+                    ),
+                    vm_names,
+                )
+                self._fail_on_errors(action)
+            else:
+                offset = self._get_log_mark(self._get_stderr_log())
+                self._vagrant_lifecycle(
+                    self._vagrant,
+                    action,
+                    vm_names if len(vm_names) < len(self.instances) else None,
+                )
+                self._fail_on_vagrant_error(action, offset)
+        self._invalidate_cache()
+
+    def package(self):
+        """Package instances into prepared boxes used by the next creates.
+
+        One running instance is packaged for each prepared box missing.
+        `vagrant package` shuts the machine down, it is started again
+        afterwards. The least recently used prepared boxes are then removed
+        until they fit in prepared_boxes_budget.
+        """
+        if not self._module.params["prepared_boxes"]:
+            self._module.fail_json(msg="state=package requires prepared_boxes")
+
+        status = self._status()
+        index = self._read_prepared_index()
+        packages = {}
+        for i in self.instances:
+            key = self._prepared_keys[i["name"]]
+            if (
+                key not in index
+                and key not in packages
+                and status.get(i["name"], {}).get("state") == "running"
+            ):
+                packages[key] = i["name"]
+
+        result = {"packaged": [], "failed": [], "evicted": []}
+        packaged = {}
+        with self._timed("package"):
+            for key, name in packages.items():
+                try:
+                    self._package_instance(name, key)
+                except Exception:
+                    result["failed"].append(name)
+                    continue
+                packaged[key] = {
+                    "box": "molecule-prepared-" + key[:16],
+                    "size": os.path.getsize(self._get_prepared_box_path(key)),
+                    "last_used": time.time(),
+                }
+                result["packaged"].append(name)
+            if packages:
+                self._invalidate_cache()
+            # NOTE: Packaging takes minutes, the index is only locked to
+            # add the new boxes to its latest content.
+            with self._prepared_index_lock():
+                index = self._read_prepared_index()
+                index.update(packaged)
+                result["evicted"] = self._evict_prepared_boxes(index)
+                self._write_prepared_index(index)
+
+        self._exit_json(
+            changed=bool(result["packaged"] or result["evicted"]), prepared=result
+        )
+
+    def _package_instance(self, instance_name, key):
+        path = self._get_prepared_box_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        v = self._get_logged_vagrant(instance_name)
+        try:
+            v._call_vagrant_command(
+                ["package", instance_name, "--output", path + ".tmp"]
+            )
+            os.replace(path + ".tmp", path)
+        finally:
+            v._call_vagrant_command(["up", instance_name, "--no-provision"])
+
+    def _evict_prepared_boxes(self, index):
+        """Remove the least recently used prepared boxes beyond the budget."""
+        evicted = []
+        total = sum(e["size"] for e in index.values())
+        for key in sorted(index, key=lambda k: index[k]["last_used"]):
+            if total <= self._module.params["prepared_boxes_budget"]:
+                break
+            entry = index.pop(key)
+            total -= entry["size"]
+            evicted.append(entry["box"])
+            try:
+                os.remove(self._get_prepared_box_path(key))
+            except OSError:
+                pass
+            try:
+                self._get_logged_vagrant()._call_vagrant_command(
+                    ["box", "remove", "--force", "--all", entry["box"]]
+                )
+            except Exception:
+                # NOTE: The box may never have been added by Vagrant.
+                pass
+        return evicted
+
+    def _get_prepared_box_path(self, key):
+        return os.path.join(self._get_vagrant_home(), PREPARED_BOXES_DIR, key + ".box")
+
+    @contextlib.contextmanager
+    def _prepared_index_lock(self):
+        """Hold the lock of the prepared boxes index, shared by the host.
+
+        Every module run using prepared boxes reads, updates and writes the
+        index back, which has to be done under this lock for the updates of
+        concurrent runs not to be lost.
+        """
+        if not self._module.params["prepared_boxes"]:
+            yield
+            return
+
+        import fcntl
+
+        path = os.path.join(
+            self._get_vagrant_home(), PREPARED_BOXES_DIR, PREPARED_BOXES_INDEX
+        )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".lock", "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            yield
+
+    def _read_prepared_index(self):
+        try:
+            with io.open(
+                os.path.join(
+                    self._get_vagrant_home(), PREPARED_BOXES_DIR, PREPARED_BOXES_INDEX
+                ),
+                "r",
+                encoding="utf-8",
+            ) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_prepared_index(self, index):
+        path = os.path.join(
+            self._get_vagrant_home(), PREPARED_BOXES_DIR, PREPARED_BOXES_INDEX
+        )
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
+
+    def _prefetch_boxes(self, instance_names):
+        """Add the boxes used by the instances before booting them.
+
+        `vagrant up` downloads missing boxes one machine after the other,
+        here each distinct box is added once and concurrently. The boxes
+        known to be present are recorded in an index under VAGRANT_HOME,
+        sparing `vagrant box list` to the next runs.
+        """
+        provider = self._module.params["provider_name"]
+        boxes = {}
+        for name in instance_names:
+            i = self._instances_config[name]
+            box = (
+                i["box"],
+                i["box_version"],
+                i["box_url"],
+                i["box_download_checksum"],
+                i["box_download_checksum_type"],
             )
-            with io.open(self._get_stderr_log(), "r", encoding="utf-8") as f:
-                self.result["stderr"] = f.read()
-                self._module.fail_json(msg=msg, **self.result)
+            boxes["{}|{}|{}".format(i["box"], i["box_version"] or "", provider)] = box
+
+        index = self._read_box_index()
+        result = {"present": [], "added": [], "failed": []}
+        missing = {}
+        for key, box in boxes.items():
+            if key in index and self._box_dir_exists(box[0], box[1], provider):
+                result["present"].append(key)
+            else:
+                missing[key] = box
+
+        if missing:
+            # NOTE: The main client would record a failure of `vagrant box
+            # list` as a failure of the run, it is only a missed shortcut.
+            try:
+                listed = set(
+                    (b.name, b.version, b.provider)
+                    for b in self._get_logged_vagrant().box_list()
+                )
+            except Exception:
+                listed = set()
+            for key, box in list(missing.items()):
+                if (box[0], box[1], provider) in listed or (
+                    box[1] is None
+                    and any(b[0] == box[0] and b[2] == provider for b in listed)
+                ):
+                    index[key] = True
+                    result["present"].append(key)
+                    del missing[key]
+
+        if missing:
+            import concurrent.futures
+
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(missing), PREFETCH_WORKERS)
+            ) as executor:
+                futures = dict(
+                    (executor.submit(self._in_phase(self._add_box), box), key)
+                    for key, box in missing.items()
+                )
+                for future in concurrent.futures.as_completed(futures):
+                    key = futures[future]
+                    try:
+                        future.result()
+                        index[key] = True
+                        result["added"].append(key)
+                    except Exception:
+                        # NOTE: Not fatal, `vagrant up` gets its own chance.
+                        result["failed"].append(key)
+
+        self._write_box_index(index)
+
+        return result
+
+    def _add_box(self, box):
+        name, version, url, checksum, checksum_type = box
+        args = ["box", "add", "--provider", self._module.params["provider_name"]]
+        if url:
+            args += ["--name", name]
+        if version:
+            args += ["--box-version", version]
+        if checksum:
+            args += ["--checksum", checksum, "--checksum-type", checksum_type]
+        args.append(url or name)
+
+        self._get_logged_vagrant()._call_vagrant_command(args)
+
+    def _get_logged_vagrant(self, instance_name=None):
+        """Return a client logging like the main one, but raising errors.
+
+        It runs in the directory of instance_name when given.
+        """
+        return TracedVagrant(
+            self._set_command,
+            out_cm=self._log_cm(self._get_stdout_log()),
+            err_cm=self._log_cm(self._get_stderr_log(), command=True),
+            root=self._get_root(instance_name),
+            env=self._vagrant.env,
+        )
+
+    def _get_vagrant_home(self):
+        return self._vagrant.env.get(
+            "VAGRANT_HOME", os.path.join(os.path.expanduser("~"), ".vagrant.d")
+        )
+
+    def _box_dir_exists(self, name, version, provider):
+        """Tell if Vagrant has a box stored, without running Vagrant."""
+        box_dir = os.path.join(
+            self._get_vagrant_home(), "boxes", name.replace("/", "-VAGRANTSLASH-")
+        )
+        if version:
+            return os.path.isdir(os.path.join(box_dir, version, provider))
+        return os.path.isdir(box_dir)
+
+    def _read_box_index(self):
+        try:
+            with io.open(
+                os.path.join(self._get_vagrant_home(), BOX_INDEX), "r", encoding="utf-8"
+            ) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_box_index(self, index):
+        path = os.path.join(self._get_vagrant_home(), BOX_INDEX)
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
+
+    def _up_instance(self, instance_name):
+        v = self._get_instance_vagrant(instance_name)
+        with self._boot_slots([instance_name]):
+            if self._status()[instance_name]["state"] in SUSPENDED_STATES:
+                self._vagrant_lifecycle(v, "resume", [instance_name])
+            else:
+                self._vagrant_up(v, [instance_name])
+
+    def _split_for_boot_slots(self, instance_names):
+        """Yield groups of instances started by a single Vagrant process.
+
+        Each one takes as many boot slots as instances, it can't be larger
+        than the number of slots. The worker pool takes one slot per
+        instance.
+        """
+        slots = self._module.params["boot_slots"]
+        if not slots or self._pooled():
+            yield instance_names
+            return
+        for i in range(0, len(instance_names), slots):
+            yield instance_names[i : i + slots]
+
+    @contextlib.contextmanager
+    def _boot_slots(self, instance_names):
+        """Hold a host-wide boot slot for each instance while it starts.
+
+        Slots are files of boot_slots_dir locked with flock(), shared by all
+        the module runs of the host, and released by the kernel should the
+        process die. All the slots needed are taken at once or none, to
+        never deadlock with another run holding some of them.
+        """
+        slots = self._module.params["boot_slots"]
+        if not slots:
+            yield
+            return
+
+        import fcntl
+
+        slots_dir = self._get_boot_slots_dir()
+        os.makedirs(slots_dir, exist_ok=True)
+        count = min(len(instance_names), slots)
+        start = time.monotonic()
+        while True:
+            held = []
+            for slot in range(slots):
+                fh = open(os.path.join(slots_dir, "slot-{}.lock".format(slot)), "a")
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    fh.close()
+                    continue
+                held.append(fh)
+                if len(held) == count:
+                    break
+            if len(held) == count:
+                break
+            for fh in held:
+                fh.close()
+            if time.monotonic() - start > self._module.params["boot_slots_timeout"]:
+                raise BootSlotTimeout(
+                    "Timed out waiting for {} boot slot(s) in {}".format(
+                        count, slots_dir
+                    )
+                )
+            time.sleep(BOOT_SLOT_POLL)
 
-    def _status_instance(self, instance_name):
+        self.result.setdefault("boot_slots", []).append(
+            {"instances": instance_names, "wait": time.monotonic() - start}
+        )
         try:
-            s = self._vagrant.status(vm_name=instance_name)[0]
+            yield
+        finally:
+            for fh in held:
+                fh.close()
+
+    def _get_boot_slots_dir(self):
+        if self._module.params["boot_slots_dir"] is not None:
+            return self._module.params["boot_slots_dir"]
+        return os.path.join(self._get_vagrant_home(), BOOT_SLOTS_DIR)
+
+    def _vagrant_lifecycle(self, v, action, vm_names=None):
+        """Run `vagrant <action>` for vm_names, or all the machines when None."""
+        args = [action] + (vm_names or [])
+        if action in ("resume", "reload"):
+            args.append("--provision" if self.provision else "--no-provision")
+        v._call_vagrant_command(args)
+
+    def _vagrant_up(self, v, vm_names=None):
+        """Run `vagrant up` for vm_names, or all the machines when None.
+
+        The output is followed when stream is enabled.
+        """
+        # NOTE: python-vagrant's up() takes a single machine name, so its
+        # command helpers are used to start several machines with a single
+        # Vagrant run, which keeps the provider parallelism.
+        args = ["up"] + (vm_names or [])
+        args.append("--provision" if self.provision else "--no-provision")
+        if not self._module.params["stream"]:
+            v._call_vagrant_command(args)
+            return
+
+        with v.out_cm() as out:
+            lines = v._stream_vagrant_command(args)
+            for event in self._progress_events(self._tee(lines, out)):
+                self._emit_progress(event)
+
+    def _tee(self, lines, fh):
+        for line in lines:
+            fh.write(line)
+            fh.flush()
+            yield line
+
+    def _progress_events(self, lines):
+        """Turn Vagrant output lines into progress events.
+
+        Every ``==> machine: message`` line marks a new phase, box downloads
+        only generate an event when their percentage changes.
+        """
+        downloads = {}
+        for line in lines:
+            m = PROGRESS_RE.match(line)
+            if m:
+                machine, percent = m.group("machine"), int(m.group("percent"))
+                if downloads.get(machine) != percent:
+                    downloads[machine] = percent
+                    yield {"machine": machine, "event": "download", "percent": percent}
+                continue
+            m = PHASE_RE.match(line)
+            if m:
+                yield {
+                    "machine": m.group("machine"),
+                    "event": "phase",
+                    "message": m.group("message").strip(),
+                }
+
+    def _emit_progress(self, event):
+        """Append event to the progress log, and phases to the module log."""
+        event["time"] = time.time()
+        with self._progress_lock:
+            self._rotate_log(self._get_vagrant_log("progress"))
+            with open(self._get_vagrant_log("progress"), "a") as fh:
+                fh.write(json.dumps(event) + "\n")
+        if event["event"] == "phase":
+            self._module.log("{machine}: {message}".format(**event))
+
+    def _destroy(self, vm_names=None):
+        """Destroy the instances named, every created one when None."""
+        if self._pooled() and vm_names is None:
+            vm_names = self._get_created_names()
+        with self._timed("destroy"):
+            if self._pooled():
+                self._run_parallel(self._destroy_instance, vm_names)
+                self._fail_on_errors("destroy")
+            elif vm_names is not None:
+                for name in vm_names:
+                    self._destroy_instance(name, self._vagrant)
+            else:
+                if self._halt_before_destroy() and self._running() > 0:
+                    self._vagrant.halt(force=True)
+                self._vagrant.destroy()
+        self._invalidate_cache()
+
+        # NOTE: Snapshots go away with their machine.
+        snapshots = self._read_snapshots()
+        if snapshots:
+            self._write_snapshots(
+                dict(
+                    (name, snapshot)
+                    for name, snapshot in snapshots.items()
+                    if vm_names is not None and name not in vm_names
+                )
+            )
+
+    def _destroy_instance(self, instance_name, v=None):
+        if v is None:
+            v = self._get_instance_vagrant(instance_name)
+        if (
+            self._halt_before_destroy()
+            and self._status()[instance_name]["state"] == "running"
+        ):
+            v.halt(vm_name=instance_name, force=True)
+        v.destroy(vm_name=instance_name)
+
+    def _snapshot_instance(self, instance_name):
+        self._vagrant_snapshot(
+            self._get_instance_vagrant(instance_name), "save", [instance_name]
+        )
+
+    def _restore_instance(self, instance_name):
+        self._vagrant_snapshot(
+            self._get_instance_vagrant(instance_name), "restore", [instance_name]
+        )
+
+    def _vagrant_snapshot(self, v, action, vm_names=None):
+        """Save or restore the snapshot of the machines, all of them if None.
+
+        `vagrant snapshot` handles one machine or all of them, a subset
+        costs one Vagrant process per machine.
+        """
+        options = {"save": ["--force"], "restore": ["--no-provision"]}[action]
+        for vm_name in vm_names or [None]:
+            v._call_vagrant_command(
+                ["snapshot", action]
+                + options
+                + ([vm_name] if vm_name else [])
+                + [self._module.params["snapshot_name"]]
+            )
+
+    def _read_snapshots(self):
+        """Return the instance name -> snapshot name index."""
+        try:
+            with io.open(self._config["snapshots"], "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_snapshots(self, snapshots):
+        path = self._config["snapshots"]
+        with open(path + ".tmp", "w") as f:
+            json.dump(snapshots, f, indent=2, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+    def _halt_before_destroy(self):
+        """Tell if force_stop needs its own `vagrant halt --force` call.
+
+        Some providers power the machine off as part of their destroy
+        action, making the extra Vagrant run a pure waste of time.
+        """
+        return (
+            self._module.params["force_stop"]
+            and self._module.params["provider_name"] not in DESTROY_HALTS_PROVIDERS
+        )
+
+    def _halt_instance(self, instance_name):
+        self._get_instance_vagrant(instance_name).halt(
+            vm_name=instance_name, force=self._module.params["force_stop"]
+        )
+
+    def _pooled(self):
+        """Tell if each instance is driven by Vagrant processes of its own."""
+        return self._workers > 1 or self._sharded
+
+    def _map_parallel(self, func, instance_names):
+        """Return [func(instance_name) ...] computed from a worker pool."""
+        if not instance_names:
+            return []
+
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self._workers, len(instance_names))
+        ) as executor:
+            return list(executor.map(self._in_phase(func), instance_names))
+
+    def _run_parallel(self, action, instance_names):
+        """Call action(instance_name) for each instance from a worker pool.
+
+        Vagrant runs some providers (e.g. virtualbox) one machine after the
+        other, so driving each machine with its own Vagrant process is the
+        only way to have them handled concurrently.  Failures are recorded
+        in the module result under ``errors``.
+        """
+        if not instance_names:
+            return
+
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(self._workers, len(instance_names))
+        ) as executor:
+            futures = dict(
+                (executor.submit(self._in_phase(action), name), name)
+                for name in instance_names
+            )
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    self._has_error = True
+                    self.result.setdefault("errors", {})[name] = {
+                        "msg": str(e),
+                        "log": self._get_vagrant_log("err", name),
+                    }
+
+    def _fail_on_errors(self, action):
+        if "errors" in self.result:
+            msg = "Failed to {} the VM(s): {}".format(
+                action, ", ".join(sorted(self.result["errors"]))
+            )
+            self._fail_json(msg)
+
+    def _fail_on_vagrant_error(self, action, offset):
+        if self._has_error:
+            msg = "Failed to {} the VM(s): See log file '{}'".format(
+                action, self._get_stderr_log()
+            )
+            self.result["stderr"] = self._read_log(self._get_stderr_log(), offset)
+            self._fail_json(msg)
+
+    def _fail_json(self, msg):
+        self._module.fail_json(msg=msg, timings=self._get_timings(), **self.result)
+
+    def _exit_json(self, **kwargs):
+        kwargs["cache"] = dict(self._cache_stats)
+        kwargs["timings"] = self._get_timings()
+        if "fragments" in self.result:
+            kwargs["fragments"] = self.result["fragments"]
+        if self._module.params["stream"]:
+            kwargs["progress"] = self._get_vagrant_log("progress")
+        if self._pooled():
+            kwargs["logs"] = dict(
+                (i["name"], self._get_vagrant_log("out", i["name"]))
+                for i in self.instances
+            )
+        self._module.exit_json(**kwargs)
+
+    def _cached(self, key, func):
+        """Return the cached value for key, calling func to fill it on a miss."""
+        if key in self._cache:
+            self._cache_stats["hits"] += 1
+        else:
+            self._cache_stats["misses"] += 1
+            self._cache[key] = func()
+
+        return self._cache[key]
+
+    def _invalidate_cache(self):
+        """Forget everything learnt from Vagrant, the machines have changed."""
+        self._cache.clear()
+
+    @contextlib.contextmanager
+    def _timed(self, phase, command=None):
+        """Add the time spent in the block to the duration of phase.
+
+        command names the Vagrant process run by the block, when it is not
+        started through python-vagrant's stderr context manager.
+        """
+        previous = getattr(self._local, "phase", None)
+        self._local.phase = phase
+        start = time.monotonic()
+        try:
+            if command is None:
+                yield
+            else:
+                with self._timed_command(command):
+                    yield
+        finally:
+            duration = time.monotonic() - start
+            self._local.phase = previous
+            with self._timings_lock:
+                phases = self._timings["phases"]
+                phases[phase] = phases.get(phase, 0) + duration
+
+    @contextlib.contextmanager
+    def _timed_command(self, command=None):
+        """Record the duration of a Vagrant process.
+
+        Its command defaults to the last one the thread was about to run,
+        see TracedVagrant.
+        """
+        if command is None:
+            command = getattr(self._local, "command", None)
+        phase = getattr(self._local, "phase", None)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - start
+            with self._timings_lock:
+                self._timings["processes"] += 1
+                self._timings["commands"].append(
+                    {"phase": phase, "command": command, "duration": duration}
+                )
+
+    def _set_command(self, args):
+        """Remember the Vagrant command the thread is about to run."""
+        args = [a for a in args if a is not None]
+        # NOTE: box and snapshot are only told apart by their own command.
+        self._local.command = " ".join(
+            args[:2] if args[0] in ("box", "snapshot") else args[:1]
+        )
+
+    def _in_phase(self, func):
+        """Return func running in the current phase, from a worker thread."""
+        phase = getattr(self._local, "phase", None)
+
+        def run(*args):
+            self._local.phase = phase
+            try:
+                return func(*args)
+            finally:
+                self._local.phase = None
+
+        return run
+
+    def _get_timings(self):
+        timings = dict(self._timings)
+        timings["total"] = time.monotonic() - self._start
+        timings["bytes_logged"] = sum(
+            os.path.getsize(f) - offset
+            for f, offset in self._log_offsets.items()
+            if os.path.exists(f)
+        )
+        if self._module.params["timings_file"]:
+            with open(self._get_timings_file(), "w") as f:
+                json.dump(timings, f, indent=2)
+
+        return timings
+
+    def _update_instance_config(self, changed):
+        """Return the ssh config of the instances, keeping instance_config.
+
+        Molecule reads how to reach each instance from its instance_config
+        file. It is (re)written when instances were started or when it
+        doesn't describe them all, otherwise its content is used instead of
+        asking Vagrant for the ssh config again.
+        """
+        filename = self._module.params["instance_config"]
+        if filename is None:
+            return self._conf(), False
+
+        if not changed:
+            instance_config = self._read_instance_config(filename)
+            if instance_config is not None:
+                return [
+                    {
+                        "Host": c["instance"],
+                        "HostName": c["address"],
+                        "User": c["user"],
+                        "Port": str(c["port"]),
+                        "IdentityFile": c["identity_file"],
+                    }
+                    for c in instance_config
+                ], False
+
+        results = self._conf()
+        self._write_instance_config(
+            filename,
+            [
+                {
+                    "instance": c["Host"],
+                    "address": c["HostName"],
+                    "user": c["User"],
+                    "port": int(c["Port"]),
+                    "identity_file": c["IdentityFile"],
+                }
+                for c in results
+            ],
+        )
+        return results, True
+
+    def _read_instance_config(self, filename):
+        """Return the instance_config entries, None when some are missing."""
+        import yaml
+
+        try:
+            with io.open(filename, "r", encoding="utf-8") as f:
+                instance_config = yaml.safe_load(f) or []
+            instance_config = dict((c["instance"], c) for c in instance_config)
+            instance_config = [instance_config[i["name"]] for i in self.instances]
+        except (IOError, KeyError, TypeError, yaml.YAMLError):
+            return None
+        if not all(set(INSTANCE_CONFIG_KEYS) <= set(c) for c in instance_config):
+            return None
+        return instance_config
+
+    def _write_instance_config(self, filename, instance_config):
+        """Atomically replace filename, readable by the user only."""
+        import yaml
+
+        tmp = filename + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            yaml.safe_dump(instance_config, f, default_flow_style=False)
+        os.chmod(tmp, 0o600)
+        os.replace(tmp, filename)
+
+    def _start_ssh_masters(self, confs):
+        """Start the ssh control master of each instance, unless running.
+
+        Masters run in the background, outliving the module run until they
+        stay ssh_control_persist without connections. An instance whose
+        socket path would be too long, or whose master fails to start, is
+        simply reached without one.
+        """
+        import concurrent.futures
+
+        control_dir = self._get_ssh_control_dir()
+        os.makedirs(control_dir, mode=0o700, exist_ok=True)
+
+        def start(c):
+            socket = os.path.join(
+                control_dir, "{}-{}-{}".format(c["HostName"], c["Port"], c["User"])
+            )
+            if len(socket) > SSH_CONTROL_PATH_MAX:
+                return False
+            ssh = [
+                "ssh",
+                "-o",
+                "ControlPath=" + os.path.join(control_dir, SSH_CONTROL_PATH),
+                "-p",
+                str(c["Port"]),
+                "-l",
+                c["User"],
+            ]
+            if self._run_ssh(ssh + ["-O", "check", c["HostName"]]):
+                return None
+            return self._run_ssh(
+                ssh
+                + SSH_OPTIONS
+                + [
+                    "-o",
+                    "ControlMaster=yes",
+                    "-o",
+                    "ControlPersist=" + self._module.params["ssh_control_persist"],
+                    "-i",
+                    c["IdentityFile"],
+                    "-N",
+                    "-f",
+                    c["HostName"],
+                ]
+            )
 
-            return {"name": s.name, "state": s.state, "provider": s.provider}
+        result = {"started": [], "failed": []}
+        if not confs:
+            return result
+        with self._timed("ssh_masters"):
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(len(confs), SSH_MASTER_WORKERS)
+            ) as executor:
+                for c, started in zip(confs, executor.map(start, confs)):
+                    if started is not None:
+                        result["started" if started else "failed"].append(c["Host"])
+        return result
+
+    def _close_ssh_masters(self):
+        """Close the ssh control masters, their instances going away."""
+        if not self._module.params["ssh_control_master"]:
+            return
+
+        control_dir = self._get_ssh_control_dir()
+        try:
+            sockets = os.listdir(control_dir)
+        except OSError:
+            return
+        for socket in sockets:
+            path = os.path.join(control_dir, socket)
+            # NOTE: The host is not looked at, a ControlPath without tokens
+            # naming the socket already.
+            self._run_ssh(["ssh", "-o", "ControlPath=" + path, "-O", "exit", socket])
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _run_ssh(self, cmd):
+        """Tell if an ssh command succeeded.
+
+        Its output is discarded, a master going to the background would
+        otherwise keep the pipes open.
+        """
+        try:
+            return (
+                subprocess.run(
+                    cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=60,
+                ).returncode
+                == 0
+            )
+        except (OSError, subprocess.SubprocessError):
+            return False
+
+    def _get_ssh_control_dir(self):
+        return os.path.join(self._config["workdir"], SSH_CONTROL_DIR)
+
+    def _conf_instance(self, instance_name):
+        try:
+            return self._cached(
+                ("conf", instance_name),
+                lambda: self._get_vagrant_of(instance_name).conf(vm_name=instance_name),
+            )
         except Exception:
-            msg = "Failed to get status for {}: See log file '{}'".format(
+            msg = "Failed to get vagrant config for {}: See log file '{}'".format(
                 instance_name, self._get_stderr_log()
             )
-            with io.open(self._get_stderr_log(), "r", encoding="utf-8") as f:
-                self.result["stderr"] = f.read()
-                self._module.fail_json(msg=msg, **self.result)
+            self.result["stderr"] = self._read_log(self._get_stderr_log())
+            self._fail_json(msg)
 
     def _conf(self):
-        conf = []
+        with self._timed("conf"):
+            try:
+                confs = self._cached("ssh-config", self._conf_all)
+            except Exception:
+                # NOTE: Fall back to one call per instance, which reports
+                # the instance that is failing.
+                confs = {}
 
-        for i in self.instances:
-            instance_name = i["name"]
-            c = self._conf_instance(instance_name)
-            if c:
-                conf.append(c)
+            conf = []
+
+            for i in self.instances:
+                instance_name = i["name"]
+                c = confs.get(instance_name) or self._conf_instance(instance_name)
+                if c:
+                    conf.append(c)
 
         return conf
 
+    def _conf_all(self):
+        """Return a name -> ssh config index covering every instance.
+
+        ``vagrant ssh-config`` without a machine name prints one ``Host``
+        section per machine, so a single Vagrant process gives the ssh
+        configuration of the whole environment. With the sharded layout,
+        each instance is asked for its own.
+        """
+        if self._sharded:
+            names = [i["name"] for i in self.instances]
+            return dict(
+                zip(
+                    names,
+                    self._map_parallel(
+                        lambda name: self._get_instance_vagrant(name).conf(
+                            vm_name=name
+                        ),
+                        names,
+                    ),
+                )
+            )
+
+        sections = {}
+        host = None
+        for line in self._vagrant.ssh_config().splitlines():
+            if line.startswith("Host "):
+                host = line.split(None, 1)[1].strip()
+                sections[host] = []
+            if host is not None:
+                sections[host].append(line)
+
+        return dict(
+            (host, self._vagrant.conf(ssh_config="\n".join(lines), vm_name=host))
+            for host, lines in sections.items()
+        )
+
     def _status(self):
-        vms_status = []
+        """Return a name -> status index covering every instance."""
+        with self._timed("status"):
+            return self._cached("status", self._get_status)
+
+    def _get_status(self):
+        """Return the status of every instance.
+
+        The machines metadata written by Vagrant in the working directory is
+        checked first, see _probe_status(). Otherwise, ``vagrant status
+        --machine-readable`` without a machine name reports all the machines
+        of the Vagrantfile, so a single Vagrant process is enough to learn
+        the state of the whole environment. With the sharded layout, each
+        instance is asked for its own.
+        """
+        vms_status = self._probe_status()
+        if vms_status is not None:
+            return vms_status
+
+        try:
+            if self._sharded:
+                statuses = sum(
+                    self._map_parallel(
+                        lambda name: self._get_instance_vagrant(name).status(),
+                        [i["name"] for i in self.instances],
+                    ),
+                    [],
+                )
+            else:
+                statuses = self._vagrant.status()
+            names = set(i["name"] for i in self.instances)
+            vms_status = {}
+            for s in statuses:
+                if s.name in names:
+                    vms_status[s.name] = {
+                        "name": s.name,
+                        "state": s.state,
+                        "provider": s.provider,
+                    }
+        except Exception:
+            msg = "Failed to get status: See log file '{}'".format(
+                self._get_stderr_log()
+            )
+            self.result["stderr"] = self._read_log(self._get_stderr_log())
+            self._fail_json(msg)
+
+        return vms_status
 
+    def _probe_status(self):
+        """Return the status of every instance without running Vagrant.
+
+        Vagrant keeps the provider id of each created machine in
+        .vagrant/machines/<name>/<provider>/id, removing it when the machine
+        is destroyed. A missing id means the machine is not created, the
+        state of the others is asked to the provider tools directly when the
+        provider is known.  Returns None as soon as the answer is not
+        certain, leaving it to `vagrant status`.
+        """
+        provider = self._module.params["provider_name"]
+        probe = {
+            "libvirt": self._probe_libvirt,
+            "virtualbox": self._probe_virtualbox,
+        }.get(provider)
+
+        ids = {}
         for i in self.instances:
-            instance_name = i["name"]
-            s = self._status_instance(instance_name)
-            if s:
-                vms_status.append(s)
+            id_file = os.path.join(
+                self._get_root(i["name"]),
+                os.environ.get("VAGRANT_DOTFILE_PATH", ".vagrant"),
+                "machines",
+                i["name"],
+                provider,
+                "id",
+            )
+            try:
+                with io.open(id_file, "r", encoding="utf-8") as f:
+                    ids[i["name"]] = f.read().strip()
+            except IOError:
+                ids[i["name"]] = None
+
+        created = [machine_id for machine_id in ids.values() if machine_id]
+        states = {}
+        if created:
+            if probe is None:
+                return None
+            with self._timed("probe"):
+                states = probe(created)
+            if states is None:
+                return None
+
+        vms_status = {}
+        for name, machine_id in ids.items():
+            state = states.get(machine_id) if machine_id else "not_created"
+            if state is None:
+                return None
+            vms_status[name] = {"name": name, "state": state, "provider": provider}
 
         return vms_status
 
+    def _probe_virtualbox(self, machine_ids):
+        running = self._run_probe(["VBoxManage", "list", "runningvms"])
+        if running is None:
+            return None
+
+        states = {}
+        for machine_id in machine_ids:
+            if "{{{}}}".format(machine_id) in running:
+                states[machine_id] = "running"
+                continue
+            info = self._run_probe(
+                ["VBoxManage", "showvminfo", machine_id, "--machine-readable"]
+            )
+            m = re.search(r'^VMState="(\w+)"', info or "", re.MULTILINE)
+            if m and m.group(1) in ("aborted", "poweroff", "saved"):
+                states[machine_id] = m.group(1)
+
+        return states
+
+    def _probe_libvirt(self, machine_ids):
+        uris = set(
+            i.get("provider_options", {}).get("uri", "qemu:///system")
+            for i in self.instances
+        )
+        if len(uris) != 1:
+            return None
+        virsh = ["virsh", "--connect", uris.pop()]
+
+        running = self._run_probe(virsh + ["list", "--uuid"])
+        if running is None:
+            return None
+        running = running.split()
+
+        states = {}
+        for machine_id in machine_ids:
+            if machine_id in running:
+                states[machine_id] = "running"
+                continue
+            # NOTE: States named as python-vagrant normalizes them.
+            state = {"shut off": "poweroff", "paused": "saved"}.get(
+                (self._run_probe(virsh + ["domstate", machine_id]) or "").strip()
+            )
+            if state is not None:
+                states[machine_id] = state
+
+        return states
+
+    def _run_probe(self, cmd):
+        """Return the output of a provider command, None when it fails."""
+        try:
+            return subprocess.run(
+                cmd,
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                universal_newlines=True,
+                timeout=30,
+            ).stdout
+        except (OSError, subprocess.SubprocessError):
+            return None
+
     def _created(self):
         status = self._status()
         if len(status) == 0:
             return 0
 
-        count = sum(map(lambda s: s["state"] == "not_created", status))
+        count = sum(map(lambda s: s["state"] == "not_created", status.values()))
         return len(status) - count
 
+    def _get_config_changes(self, status):
+        """Compare the config of the created instances with their last up.
+
+        Running or suspended instances are reloaded to apply a change, the
+        others get it when started, and a change of box or provider means
+        recreating the instance.
+        """
+        saved = self._read_instances_config()
+        changes = []
+        for i in self.instances:
+            name = i["name"]
+            state = status.get(name, {}).get("state", "not_created")
+            if name not in saved or state == "not_created":
+                continue
+            current = self._get_effective_config(name)
+            keys = sorted(
+                k
+                for k in set(saved[name]) | set(current)
+                if saved[name].get(k) != current.get(k)
+            )
+            if not keys:
+                continue
+            if any(k in RECREATE_KEYS for k in keys):
+                action = "recreate"
+            elif state == "running" or state in SUSPENDED_STATES:
+                action = "reload"
+            else:
+                action = "up"
+            changes.append({"name": name, "action": action, "keys": keys})
+        return changes
+
+    def _get_effective_config(self, instance_name):
+        """Return the config of the instance, as its base box would have."""
+        config = dict(self._instances_config[instance_name])
+        config.update(self._base_boxes.get(instance_name, {}))
+        return json.loads(json.dumps(config, sort_keys=True, default=str))
+
+    def _read_instances_config(self):
+        try:
+            with io.open(self._config["instances_config"], "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_instances_config(self):
+        path = self._config["instances_config"]
+        with open(path + ".tmp", "w") as f:
+            json.dump(
+                dict(
+                    (i["name"], self._get_effective_config(i["name"]))
+                    for i in self.instances
+                ),
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        os.replace(path + ".tmp", path)
+
+    def _get_created_names(self):
+        status = self._status()
+        return [
+            i["name"]
+            for i in self.instances
+            if status.get(i["name"], {}).get("state", "not_created") != "not_created"
+        ]
+
     def _running(self):
         status = self._status()
         if len(status) == 0:
             return 0
 
-        count = sum(map(lambda s: s["state"] == "running", status))
+        count = sum(map(lambda s: s["state"] == "running", status.values()))
         return count
 
     def _get_config(self):
@@ -551,32 +2454,127 @@ class VagrantClient(object):
                 msg="Either workdir parameter or MOLECULE_EPHEMERAL_DIRECTORY env variable has to be set"
             )
         conf["vagrantfile"] = os.path.join(conf["workdir"], "Vagrantfile")
+        conf["digest"] = os.path.join(conf["workdir"], "Vagrantfile.sha256")
+        conf["instances_config"] = os.path.join(
+            conf["workdir"], "vagrant-instances.json"
+        )
+        conf["snapshots"] = os.path.join(conf["workdir"], "vagrant-snapshots.json")
+        conf["template_cache"] = os.path.join(conf["workdir"], "vagrantfile-cache")
+        conf["shards"] = os.path.join(conf["workdir"], SHARDS_DIR)
         return conf
 
-    def _write_vagrantfile(self):
-        instances = self._get_vagrant_config_dict()
-        template = molecule.util.render_template(
-            VAGRANTFILE_TEMPLATE,
-            instances=instances,
-            cachier=self.cachier,
-            no_kvm=not os.path.exists("/dev/kvm"),
-        )
-        molecule.util.write_file(self._vagrantfile, template)
+    def _write_vagrantfile(self, instances, no_kvm):
+        with self._timed("write_vagrantfile"):
+            renderer = VagrantfileRenderer(self._config["template_cache"])
+            template = renderer.render(instances, self.cachier, no_kvm)
+            write_file(self._vagrantfile, template)
+            self.result["fragments"] = renderer.stats
 
     def _write_configs(self):
-        self._write_vagrantfile()
+        with self._prepared_index_lock():
+            if self._module.params["prepared_boxes"]:
+                self._prepared_index = self._read_prepared_index()
+            instances = self._get_vagrant_config_dict()
+            if self._prepared_keys:
+                self._write_prepared_index(self._prepared_index)
+        self._instances_config = dict((i["name"], i) for i in instances)
+        no_kvm = not os.path.exists("/dev/kvm")
+        if self._sharded:
+            self._write_shards(instances, no_kvm)
+            return
+
+        # NOTE: Leave an up to date Vagrantfile alone, rewriting it changes
+        # its mtime and `vagrant validate` costs a whole Vagrant startup.
+        digest = self._get_configs_digest(instances, no_kvm)
+        if os.path.exists(self._vagrantfile) and digest == self._read_digest(
+            self._config["digest"]
+        ):
+            return
+
+        self._write_vagrantfile(instances, no_kvm)
+        try:
+            with self._timed("validate", command="validate"):
+                self._vagrant.validate(self._config["workdir"])
+        except subprocess.CalledProcessError as e:
+            self._module.fail_json(
+                msg=f"Failed to validate generated Vagrantfile: {e.stderr}"
+            )
+        write_file(self._config["digest"], digest, header="")
+
+    def _write_shards(self, instances, no_kvm):
+        """Write the Vagrantfile of each instance into its own directory.
+
+        Like the single Vagrantfile, a shard is only rendered and validated
+        again when its instance changed, the validations running from the
+        worker pool.
+        """
+        renderer = VagrantfileRenderer(self._config["template_cache"])
+        changed = {}
+        with self._timed("write_vagrantfile"):
+            for instance in instances:
+                root = self._get_root(instance["name"])
+                vagrantfile = os.path.join(root, "Vagrantfile")
+                digest = self._get_configs_digest([instance], no_kvm)
+                if os.path.exists(vagrantfile) and digest == self._read_digest(
+                    vagrantfile + ".sha256"
+                ):
+                    continue
+                os.makedirs(root, exist_ok=True)
+                write_file(
+                    vagrantfile,
+                    renderer.render([instance], self.cachier, no_kvm, save=False),
+                )
+                changed[vagrantfile] = digest
+            if changed:
+                renderer.save()
+        if not changed:
+            return
+        self.result["fragments"] = renderer.stats
+
+        def validate(vagrantfile):
+            with self._timed_command("validate"):
+                self._vagrant.validate(os.path.dirname(vagrantfile))
+
         try:
-            self._vagrant.validate(self._config["workdir"])
+            with self._timed("validate"):
+                self._map_parallel(validate, list(changed))
         except subprocess.CalledProcessError as e:
             self._module.fail_json(
                 msg=f"Failed to validate generated Vagrantfile: {e.stderr}"
             )
+        for vagrantfile, digest in changed.items():
+            write_file(vagrantfile + ".sha256", digest, header="")
+
+    def _get_configs_digest(self, instances, no_kvm):
+        """Return a digest of everything the Vagrantfile is rendered from."""
+        data = json.dumps(
+            {
+                "instances": instances,
+                "cachier": self.cachier,
+                "no_kvm": no_kvm,
+                "provider": self._module.params["provider_name"],
+                "template": VAGRANTFILE_MACROS
+                + VAGRANTFILE_INSTANCE_TEMPLATE
+                + VAGRANTFILE_TEMPLATE,
+            },
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def _read_digest(self, filename):
+        try:
+            with io.open(filename, "r", encoding="utf-8") as f:
+                return f.read().strip()
+        except IOError:
+            return None
 
     def _get_vagrant(self):
         vagrant_env = os.environ.copy()
         if self._module.params["parallel"] is False:
             vagrant_env["VAGRANT_NO_PARALLEL"] = "1"
-        v = vagrant.Vagrant(
+        v = TracedVagrant(
+            self._set_command,
             out_cm=self.stdout_cm,
             err_cm=self.stderr_cm,
             root=self._config["workdir"],
@@ -585,6 +2583,33 @@ class VagrantClient(object):
 
         return v
 
+    def _get_instance_vagrant(self, instance_name):
+        """Return a Vagrant object logging to the instance's own files."""
+        if instance_name not in self._instance_vagrants:
+            self._instance_vagrants[instance_name] = TracedVagrant(
+                self._set_command,
+                out_cm=self._log_cm(self._get_vagrant_log("out", instance_name)),
+                err_cm=self._log_cm(
+                    self._get_vagrant_log("err", instance_name), command=True
+                ),
+                root=self._get_root(instance_name),
+                env=self._vagrant.env,
+            )
+
+        return self._instance_vagrants[instance_name]
+
+    def _get_vagrant_of(self, instance_name):
+        """Return the main client, or the instance's own one when sharded."""
+        if self._sharded:
+            return self._get_instance_vagrant(instance_name)
+        return self._vagrant
+
+    def _get_root(self, instance_name=None):
+        """Return the directory of the Vagrantfile defining instance_name."""
+        if self._sharded and instance_name is not None:
+            return os.path.join(self._config["shards"], instance_name)
+        return self._config["workdir"]
+
     def _get_instance_vagrant_config_dict(self, instance):
 
         checksum = instance.get("box_download_checksum")
@@ -636,9 +2661,7 @@ class VagrantClient(object):
         }
 
         d["config_options"].update(
-            molecule.util.merge_dicts(
-                d["config_options"], instance.get("config_options", {})
-            )
+            merge_dicts(d["config_options"], instance.get("config_options", {}))
         )
         if "cachier" in d["config_options"]:
             self.cachier = d["config_options"]["cachier"]
@@ -647,26 +2670,115 @@ class VagrantClient(object):
             )
 
         d["provider_options"].update(
-            molecule.util.merge_dicts(
-                d["provider_options"], instance.get("provider_options", {})
-            )
+            merge_dicts(d["provider_options"], instance.get("provider_options", {}))
         )
 
+        if self._module.params["prepared_boxes"]:
+            self._use_prepared_box(d)
+
         return d
 
+    def _use_prepared_box(self, d):
+        """Make the instance use its prepared box, when there is one."""
+        key = self._get_prepared_box_key(d)
+        self._prepared_keys[d["name"]] = key
+        entry = self._prepared_index.get(key)
+        path = self._get_prepared_box_path(key)
+        if entry is None or not os.path.exists(path):
+            return
+
+        self._base_boxes[d["name"]] = dict((k, d[k]) for k in BOX_KEYS)
+        d.update(
+            box=entry["box"],
+            box_version=None,
+            box_url="file://" + path,
+            box_download_checksum=None,
+            box_download_checksum_type=None,
+        )
+        entry["last_used"] = time.time()
+
+    def _get_prepared_box_key(self, d):
+        """Return a digest of what a prepared box is made from."""
+        if self._prepare_playbook is None:
+            self._prepare_playbook = ""
+            if self._module.params["prepare_playbook"] is not None:
+                with io.open(
+                    self._module.params["prepare_playbook"], "r", encoding="utf-8"
+                ) as f:
+                    self._prepare_playbook = f.read()
+        data = json.dumps(
+            [d["box"], d["box_version"], d["provider"], self._prepare_playbook]
+        )
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
     def _get_vagrant_config_dict(self):
         config_list = []
         for instance in self.instances:
             config_list.append(self._get_instance_vagrant_config_dict(instance))
         return config_list
 
+    def _get_timings_file(self):
+        return os.path.join(self._config["workdir"], "timings.json")
+
     def _get_stdout_log(self):
         return self._get_vagrant_log("out")
 
     def _get_stderr_log(self):
         return self._get_vagrant_log("err")
 
-    def _get_vagrant_log(self, __type):
+    def _open_log(self, filename):
+        """Open a log file for appending, see _rotate_log()."""
+        self._rotate_log(filename)
+        fh = open(filename, "a+")
+        fh.write("### {} ###\n".format(self._datetime))
+        fh.flush()
+
+        return fh
+
+    def _rotate_log(self, filename):
+        """Prepare a log file to be appended to by this module run.
+
+        The first time a log is opened by a module run, it's rotated once
+        it reached log_max_size and the offset where the run starts is
+        recorded, for _read_log() to only return what the run wrote.
+        """
+        if filename in self._log_offsets:
+            return
+        try:
+            offset = os.path.getsize(filename)
+        except OSError:
+            offset = 0
+        if offset >= self._module.params["log_max_size"]:
+            os.replace(filename, filename + ".1")
+            offset = 0
+        self._log_offsets[filename] = offset
+
+    def _get_log_mark(self, filename):
+        """Return the offset the next writes to a log file will start from.
+
+        None stands for the start of the run, the log not having been
+        opened (and maybe rotated) by this run yet.
+        """
+        if filename not in self._log_offsets:
+            return None
+        return os.path.getsize(filename)
+
+    def _read_log(self, filename, offset=None):
+        """Return what this module run wrote to a log file."""
+        if offset is None:
+            offset = self._log_offsets.get(filename)
+        if offset is None:
+            return ""
+        with open(filename, "rb") as f:
+            f.seek(offset)
+            return f.read().decode("utf-8", errors="replace")
+
+    def _get_vagrant_log(self, __type, instance_name=None):
+        if instance_name is not None:
+            return os.path.join(
+                self._config["workdir"],
+                "vagrant-{}.{}".format(instance_name, __type),
+            )
         return os.path.join(self._config["workdir"], "vagrant.{}".format(__type))
 
 
@@ -693,9 +2805,41 @@ def main():
             provision=dict(type="bool", default=False),
             force_stop=dict(type="bool", default=False),
             cachier=dict(type="str", default="machine"),
-            state=dict(type="str", default="up", choices=["up", "destroy", "halt"]),
+            state=dict(
+                type="str",
+                default="up",
+                choices=[
+                    "up",
+                    "destroy",
+                    "halt",
+                    "suspend",
+                    "resume",
+                    "snapshot",
+                    "restore",
+                    "package",
+                ],
+            ),
             workdir=dict(type="str"),
             parallel=dict(type="bool", default=True),
+            max_workers=dict(type="int", default=1),
+            layout=dict(type="str", default="single", choices=["single", "sharded"]),
+            log_max_size=dict(type="int", default=10485760),
+            stream=dict(type="bool", default=False),
+            timings_file=dict(type="bool", default=False),
+            prefetch_boxes=dict(type="bool", default=False),
+            instance_config=dict(type="path", default=None),
+            snapshot_name=dict(type="str", default="molecule"),
+            admission=dict(type="bool", default=False),
+            admission_memory_headroom=dict(type="int", default=1024),
+            admission_cpu_ratio=dict(type="float", default=1.0),
+            boot_slots=dict(type="int", default=0),
+            boot_slots_dir=dict(type="path", default=None),
+            boot_slots_timeout=dict(type="int", default=3600),
+            prepared_boxes=dict(type="bool", default=False),
+            prepared_boxes_budget=dict(type="int", default=10737418240),
+            prepare_playbook=dict(type="path", default=None),
+            ssh_control_master=dict(type="bool", default=False),
+            ssh_control_persist=dict(type="str", default="30m"),
         ),
         required_together=[
             ("platform_box_download_checksum", "platform_box_download_checksum_type"),
@@ -720,6 +2864,21 @@ def main():
     if module.params["state"] == "halt":
         v.halt()
 
+    if module.params["state"] == "suspend":
+        v.suspend()
+
+    if module.params["state"] == "resume":
+        v.resume()
+
+    if module.params["state"] == "snapshot":
+        v.snapshot()
+
+    if module.params["state"] == "restore":
+        v.restore()
+
+    if module.params["state"] == "package":
+        v.package()
+
     module.fail_json(msg="Unknown error", **v.result)
 
 
@@ -0,0 +1,187 @@
+"""Stand-in for the vagrant executable, used by the benchmarks.
+
+It knows the machines defined by the Vagrantfile of the current directory
+and keeps their state and snapshots in .vagrant/, like Vagrant does. Every
+invocation is appended to the file named by FAKE_VAGRANT_CALLS, along with
+the directory it runs in, and lasts at least FAKE_VAGRANT_LATENCY seconds,
+Vagrant itself needing a few seconds just to start. The commands listed in
+FAKE_VAGRANT_FAIL, separated by commas, fail. Boxes are added to and
+removed from $VAGRANT_HOME/boxes, and packaged into BOX_SIZE bytes files.
+
+Machines are reported as using the "fake" provider, which the module can't
+probe, so that the number of processes doesn't depend on the tools
+installed on the host.
+"""
+
+import os
+import re
+import shutil
+import sys
+import time
+
+PROVIDER = "fake"
+BOX_SIZE = 1024
+
+
+def get_machines():
+    try:
+        with open("Vagrantfile") as f:
+            return re.findall(r'config\.vm\.define "([^"]+)"', f.read())
+    except IOError:
+        return []
+
+
+def get_id_file(machine):
+    return os.path.join(".vagrant", "machines", machine, PROVIDER, "id")
+
+
+def get_state(machine):
+    try:
+        with open(get_id_file(machine)) as f:
+            return f.read().strip() or "not_created"
+    except IOError:
+        return "not_created"
+
+
+def set_state(machine, state):
+    id_file = get_id_file(machine)
+    if state == "not_created":
+        if os.path.exists(id_file):
+            os.remove(id_file)
+        return
+    os.makedirs(os.path.dirname(id_file), exist_ok=True)
+    with open(id_file, "w") as f:
+        f.write(state)
+
+
+def get_snapshot_file(machine, name):
+    return os.path.join(".vagrant", "machines", machine, PROVIDER, "snapshots", name)
+
+
+def snapshot(action, targets, name):
+    """Save, restore or list the snapshots, a snapshot keeping the state."""
+    for m in targets:
+        if get_state(m) == "not_created":
+            sys.stderr.write("The machine {} is not created.\n".format(m))
+            return 1
+        if action == "list":
+            print("==> {}:".format(m))
+            try:
+                for snapshot_name in os.listdir(get_snapshot_file(m, "")):
+                    print(snapshot_name)
+            except OSError:
+                print("No snapshots have been taken yet!")
+        elif action == "save":
+            os.makedirs(os.path.dirname(get_snapshot_file(m, name)), exist_ok=True)
+            with open(get_snapshot_file(m, name), "w") as f:
+                f.write(get_state(m))
+        elif action == "restore":
+            try:
+                with open(get_snapshot_file(m, name)) as f:
+                    f.read()
+            except IOError:
+                sys.stderr.write("The snapshot {} doesn't exist.\n".format(name))
+                return 1
+            # NOTE: Vagrant starts the machine once restored.
+            set_state(m, "running")
+    return 0
+
+
+def get_box_dir(name):
+    home = os.environ.get("VAGRANT_HOME", os.path.expanduser("~/.vagrant.d"))
+    return os.path.join(home, "boxes", name.replace("/", "-VAGRANTSLASH-"))
+
+
+def box(action, args):
+    """Add, remove or list the boxes, all having version 0."""
+    if action == "list":
+        home = os.path.dirname(get_box_dir("x"))
+        for name in sorted(os.listdir(home)) if os.path.isdir(home) else []:
+            print("1,,box-name,{}".format(name.replace("-VAGRANTSLASH-", "/")))
+            print("1,,box-provider,{}".format(PROVIDER))
+            print("1,,box-version,0")
+    elif action == "add":
+        name = args[-1]
+        if "--name" in sys.argv:
+            name = sys.argv[sys.argv.index("--name") + 1]
+        os.makedirs(os.path.join(get_box_dir(name), "0", PROVIDER), exist_ok=True)
+    elif action == "remove":
+        shutil.rmtree(get_box_dir(args[-1]), ignore_errors=True)
+    return 0
+
+
+def package(machine, output):
+    if get_state(machine) == "not_created":
+        sys.stderr.write("The machine {} is not created.\n".format(machine))
+        return 1
+    with open(output, "w") as f:
+        f.write("x" * BOX_SIZE)
+    # NOTE: Vagrant shuts the machine down to package it.
+    set_state(machine, "poweroff")
+    return 0
+
+
+def main(argv):
+    calls = os.environ.get("FAKE_VAGRANT_CALLS")
+    if calls:
+        with open(calls, "a") as f:
+            f.write("{}\t{}\n".format(os.getcwd(), " ".join(argv)))
+    time.sleep(float(os.environ.get("FAKE_VAGRANT_LATENCY", 0)))
+
+    args = [a for a in argv if not a.startswith("-")]
+    command = args[0] if args else "help"
+    machines = get_machines()
+    targets = [a for a in args[1:] if a in machines] or machines
+
+    if command in os.environ.get("FAKE_VAGRANT_FAIL", "").split(","):
+        sys.stderr.write("The {} command failed.\n".format(command))
+        return 1
+    if command == "status":
+        for m in targets:
+            print("1,{},provider-name,{}".format(m, PROVIDER))
+            print("1,{},state,{}".format(m, get_state(m)))
+    elif command == "ssh-config":
+        for m in targets:
+            if get_state(m) != "running":
+                sys.stderr.write("The machine {} is not running.\n".format(m))
+                return 1
+            print("Host {}".format(m))
+            print("  HostName 127.0.0.1")
+            print("  User vagrant")
+            print("  Port {}".format(2200 + machines.index(m)))
+            print("  IdentityFile {}".format(os.path.abspath(m + ".key")))
+            print("")
+    elif command == "up":
+        for m in targets:
+            print("==> {}: Booting VM...".format(m))
+            set_state(m, "running")
+    elif command == "halt":
+        for m in targets:
+            if get_state(m) == "running":
+                set_state(m, "poweroff")
+    elif command == "suspend":
+        for m in targets:
+            if get_state(m) == "running":
+                set_state(m, "saved")
+    elif command == "resume":
+        for m in targets:
+            if get_state(m) == "saved":
+                set_state(m, "running")
+    elif command == "destroy":
+        for m in targets:
+            set_state(m, "not_created")
+    elif command == "box":
+        return box(args[1] if len(args) > 1 else "list", args)
+    elif command == "package":
+        return package(targets[0], argv[argv.index("--output") + 1])
+    elif command == "snapshot":
+        action = args[1] if len(args) > 1 else "list"
+        name = args[-1] if action in ("save", "restore") else None
+        return snapshot(action, targets, name)
+    elif command == "validate":
+        print("Vagrantfile validated successfully.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,304 @@
+"""Benchmarks of the vagrant module against a fake vagrant executable.
+
+Each run of the module and of the create/destroy playbooks is measured:
+Vagrant processes started, wall time and peak RSS. The measures are
+written as JSON to $MOLECULE_VAGRANT_BENCHMARK_RESULTS when set, and
+compared to a previous results file given by
+$MOLECULE_VAGRANT_BENCHMARK_BASELINE, failing on regressions.
+
+$MOLECULE_VAGRANT_BENCHMARK_COUNTS (default 1,10) sets the numbers of
+instances and $MOLECULE_VAGRANT_BENCHMARK_LATENCY (default 0) how many
+seconds each Vagrant process lasts. The default counts keep the test suite
+fast, larger environments are measured on demand, e.g. with
+MOLECULE_VAGRANT_BENCHMARK_COUNTS=1,10,50,200. Timings are only compared to
+each other when the counts are given, a busy machine making them noisy.
+"""
+
+import collections
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+
+from molecule_vagrant.modules.vagrant import VagrantfileRenderer
+from molecule_vagrant.test.test_vagrant_module import _instance
+
+COUNTS = os.environ.get("MOLECULE_VAGRANT_BENCHMARK_COUNTS", "1,10")
+COUNTS = [int(c) for c in COUNTS.split(",")]
+COMPARE_TIMINGS = "MOLECULE_VAGRANT_BENCHMARK_COUNTS" in os.environ
+LATENCY = os.environ.get("MOLECULE_VAGRANT_BENCHMARK_LATENCY", "0")
+
+# NOTE: Vagrant processes allowed for each action, whatever the number of
+# instances: one per instance means an N+1 pattern came back.
+MAX_VAGRANT_PROCESSES = {
+    # validate, up, status, ssh-config
+    "create": 4,
+    # status, halt, destroy
+    "destroy": 3,
+}
+
+# NOTE: With the sharded layout, Vagrant processes allowed in the directory
+# of each instance and in the scenario directory, whatever the number of
+# instances.
+MAX_SHARDED_VAGRANT_PROCESSES = {
+    # validate, up, status, ssh-config
+    "create": {"instance": 4, "overhead": 0},
+    # status, halt, destroy
+    "destroy": {"instance": 3, "overhead": 0},
+}
+
+# NOTE: How much slower or bigger than the baseline a run may be.
+TOLERANCE = {"wall_time": 1.5, "peak_rss_kb": 1.25}
+
+PLAYBOOKS = os.path.join(os.path.dirname(__file__), "..", "..", "playbooks")
+
+RESULTS = {}
+
+# NOTE: Best time to render the Vagrantfile again after one platform changed,
+# for each count.
+RENDER_WARM = {}
+
+
+def _load_baseline():
+    baseline = os.environ.get("MOLECULE_VAGRANT_BENCHMARK_BASELINE")
+    if not baseline:
+        return {}
+    with open(baseline) as f:
+        return json.load(f)
+
+
+BASELINE = _load_baseline()
+
+
+@pytest.fixture(scope="module", autouse=True)
+def results():
+    yield RESULTS
+    filename = os.environ.get("MOLECULE_VAGRANT_BENCHMARK_RESULTS")
+    if filename:
+        with open(filename, "w") as f:
+            json.dump(RESULTS, f, indent=2, sort_keys=True)
+
+
+@pytest.fixture
+def env(fake_vagrant_env):
+    fake_vagrant_env["FAKE_VAGRANT_LATENCY"] = LATENCY
+    return fake_vagrant_env
+
+
+def _platforms(count):
+    return [{"name": "instance-{}".format(i)} for i in range(count)]
+
+
+def _run(name, count, cmd, env, max_processes=None):
+    """Run cmd, record its measures under name and return its stdout."""
+    calls = env["FAKE_VAGRANT_CALLS"]
+    if os.path.exists(calls):
+        os.remove(calls)
+
+    start = time.monotonic()
+    with open(
+        os.path.join(env["MOLECULE_EPHEMERAL_DIRECTORY"], "..", "stderr"), "w"
+    ) as err:
+        proc = subprocess.Popen(
+            cmd,
+            env=env,
+            cwd=env["MOLECULE_EPHEMERAL_DIRECTORY"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=err,
+        )
+        stdout = proc.stdout.read()
+        proc.stdout.close()
+        _, status, rusage = os.wait4(proc.pid, 0)
+    wall_time = time.monotonic() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    assert proc.returncode == 0, stdout
+
+    with open(calls) as f:
+        processes = len(f.readlines())
+    key = "{}-{}".format(name, count)
+    RESULTS[key] = {
+        "instances": count,
+        "vagrant_processes": processes,
+        "wall_time": wall_time,
+        "peak_rss_kb": rusage.ru_maxrss,
+    }
+
+    if max_processes is None:
+        max_processes = MAX_VAGRANT_PROCESSES[name.rsplit("-", 1)[-1]]
+    assert processes <= max_processes
+    for measure, tolerance in TOLERANCE.items():
+        if key in BASELINE:
+            assert RESULTS[key][measure] <= BASELINE[key][measure] * tolerance, (
+                key,
+                measure,
+            )
+    return stdout
+
+
+def _run_module(name, count, env, max_processes=None, **args):
+    args_file = os.path.join(env["MOLECULE_EPHEMERAL_DIRECTORY"], "..", "args.json")
+    with open(args_file, "w") as f:
+        json.dump({"ANSIBLE_MODULE_ARGS": args}, f)
+    stdout = _run(
+        name,
+        count,
+        [
+            sys.executable,
+            "-c",
+            "from molecule_vagrant.modules import vagrant; vagrant.main()",
+            args_file,
+        ],
+        env,
+        max_processes,
+    )
+    result = json.loads(stdout)
+    assert not result.get("failed"), result
+    return result
+
+
+@pytest.mark.parametrize("count", COUNTS)
+def test_module(count, env):
+    args = {
+        "instances": _platforms(count),
+        "default_box": "molecule/fake",
+        "provider_name": "fake",
+    }
+    instance_config = os.path.join(
+        env["MOLECULE_EPHEMERAL_DIRECTORY"], "instance_config.yml"
+    )
+
+    result = _run_module(
+        "module-create",
+        count,
+        env,
+        state="up",
+        instance_config=instance_config,
+        **args,
+    )
+    assert len(result["results"]) == count
+    assert os.path.exists(instance_config)
+
+    _run_module("module-destroy", count, env, state="destroy", force_stop=True, **args)
+
+
+def _get_calls_per_directory(env):
+    """Return the number of Vagrant processes run in each directory."""
+    with open(env["FAKE_VAGRANT_CALLS"]) as f:
+        return collections.Counter(line.split("\t", 1)[0] for line in f)
+
+
+def _run_sharded(action, count, env, **args):
+    limits = MAX_SHARDED_VAGRANT_PROCESSES[action]
+    result = _run_module(
+        "sharded-" + action,
+        count,
+        env,
+        limits["instance"] * count + limits["overhead"],
+        **args,
+    )
+
+    workdir = env["MOLECULE_EPHEMERAL_DIRECTORY"]
+    calls = _get_calls_per_directory(env)
+    assert calls.pop(workdir, 0) <= limits["overhead"]
+    assert len(calls) == count
+    for directory, processes in calls.items():
+        assert os.path.dirname(directory) == os.path.join(workdir, "vagrant-shards")
+        assert processes <= limits["instance"], directory
+    return result
+
+
+@pytest.mark.parametrize("count", COUNTS)
+def test_module_sharded(count, env):
+    args = {
+        "instances": _platforms(count),
+        "default_box": "molecule/fake",
+        "provider_name": "fake",
+        "layout": "sharded",
+        "max_workers": 4,
+    }
+    instance_config = os.path.join(
+        env["MOLECULE_EPHEMERAL_DIRECTORY"], "instance_config.yml"
+    )
+
+    result = _run_sharded(
+        "create", count, env, state="up", instance_config=instance_config, **args
+    )
+    assert len(result["results"]) == count
+
+    _run_sharded("destroy", count, env, state="destroy", force_stop=True, **args)
+
+
+@pytest.mark.skipif(
+    shutil.which("ansible-playbook") is None, reason="ansible-playbook is missing"
+)
+@pytest.mark.parametrize("count", COUNTS)
+def test_playbooks(count, env, tmp_path):
+    extra_vars = tmp_path / "vars.json"
+    extra_vars.write_text(
+        json.dumps(
+            {
+                "ansible_python_interpreter": sys.executable,
+                "molecule_no_log": False,
+                "molecule_instance_config": str(tmp_path / "instance_config.yml"),
+                "molecule_yml": {
+                    "driver": {"provider": {"name": "fake"}},
+                    "platforms": _platforms(count),
+                },
+            }
+        )
+    )
+
+    for action in ("create", "destroy"):
+        _run(
+            "playbook-" + action,
+            count,
+            [
+                shutil.which("ansible-playbook"),
+                "-i",
+                "localhost,",
+                "-e",
+                "@{}".format(extra_vars),
+                os.path.join(PLAYBOOKS, action + ".yml"),
+            ],
+            env,
+        )
+        if action == "create":
+            assert (tmp_path / "instance_config.yml").exists()
+
+
+@pytest.mark.parametrize("count", COUNTS)
+def test_render(count, tmp_path):
+    # Changing one platform only renders its block again: the time it takes
+    # grows at most a quarter as fast as the number of instances, and is
+    # well below a cold render.
+    instances = [_instance(i) for i in range(count)]
+
+    start = time.perf_counter()
+    VagrantfileRenderer(str(tmp_path)).render(instances, "machine", False)
+    cold = time.perf_counter() - start
+
+    warm = []
+    for memory in (1024, 2048, 4096):
+        instances[0]["memory"] = memory
+        renderer = VagrantfileRenderer(str(tmp_path))
+        start = time.perf_counter()
+        renderer.render(instances, "machine", False)
+        warm.append(time.perf_counter() - start)
+        assert renderer.stats == {"rendered": 1, "reused": count - 1}
+    RENDER_WARM[count] = min(warm)
+
+    for name, wall_time in (("render-cold", cold), ("render-warm", min(warm))):
+        key = "{}-{}".format(name, count)
+        RESULTS[key] = {"instances": count, "wall_time": wall_time}
+        if key in BASELINE:
+            assert wall_time <= BASELINE[key]["wall_time"] * TOLERANCE["wall_time"]
+
+    if COMPARE_TIMINGS:
+        assert min(warm) < cold / 2
+        smallest = min(RENDER_WARM)
+        assert RENDER_WARM[count] <= RENDER_WARM[smallest] * (1 + count / smallest / 4)
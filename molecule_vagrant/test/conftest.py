@@ -0,0 +1,161 @@
+"""Fixtures running the vagrant module against a fake vagrant executable."""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+FAKE_VAGRANT = os.path.join(os.path.dirname(__file__), "benchmark", "fake_vagrant.py")
+MODULES = os.path.join(os.path.dirname(__file__), "..", "modules")
+
+
+@pytest.fixture
+def fake_vagrant_env(tmp_path):
+    """Return the environment of a run using fake_vagrant.py as vagrant."""
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    fake = bindir / "vagrant"
+    fake.write_text(
+        '#!/bin/sh\nexec "{}" "{}" "$@"\n'.format(sys.executable, FAKE_VAGRANT)
+    )
+    fake.chmod(0o755)
+
+    workdir = tmp_path / "ephemeral"
+    workdir.mkdir()
+
+    env = os.environ.copy()
+    env.update(
+        {
+            "PATH": "{}:{}".format(bindir, env.get("PATH", "")),
+            "FAKE_VAGRANT_CALLS": str(tmp_path / "calls"),
+            "FAKE_VAGRANT_LATENCY": "0",
+            "MOLECULE_EPHEMERAL_DIRECTORY": str(workdir),
+            "ANSIBLE_LIBRARY": os.path.abspath(MODULES),
+            "ANSIBLE_LOCALHOST_WARNING": "false",
+            "ANSIBLE_NOCOLOR": "true",
+        }
+    )
+    return env
+
+
+@pytest.fixture
+def run_module(fake_vagrant_env, tmp_path):
+    """Return a function running the vagrant module with the given args."""
+
+    def run(**args):
+        args_file = tmp_path / "args.json"
+        args_file.write_text(json.dumps({"ANSIBLE_MODULE_ARGS": args}))
+        stdout = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "from molecule_vagrant.modules import vagrant; vagrant.main()",
+                str(args_file),
+            ],
+            env=fake_vagrant_env,
+            cwd=fake_vagrant_env["MOLECULE_EPHEMERAL_DIRECTORY"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        ).stdout
+        return json.loads(stdout)
+
+    return run
+
+
+# NOTE: The defaults of the module's argument_spec, see main().
+MODULE_PARAMS = {
+    "instances": None,
+    "instance_name": None,
+    "instance_interfaces": [],
+    "instance_raw_config_args": None,
+    "config_options": {},
+    "platform_box": None,
+    "platform_box_version": None,
+    "platform_box_url": None,
+    "platform_box_download_checksum": None,
+    "platform_box_download_checksum_type": None,
+    "provider_memory": 512,
+    "provider_cpus": 2,
+    "provider_options": {},
+    "provider_override_args": None,
+    "provider_raw_config_args": None,
+    "provider_name": "virtualbox",
+    "default_box": None,
+    "provision": False,
+    "force_stop": False,
+    "cachier": "machine",
+    "state": "up",
+    "workdir": None,
+    "parallel": True,
+    "max_workers": 1,
+    "layout": "single",
+    "log_max_size": 10485760,
+    "stream": False,
+    "timings_file": False,
+    "prefetch_boxes": False,
+    "instance_config": None,
+    "snapshot_name": "molecule",
+    "admission": False,
+    "admission_memory_headroom": 1024,
+    "admission_cpu_ratio": 1.0,
+    "boot_slots": 0,
+    "boot_slots_dir": None,
+    "boot_slots_timeout": 3600,
+    "prepared_boxes": False,
+    "prepared_boxes_budget": 10737418240,
+    "prepare_playbook": None,
+    "ssh_control_master": False,
+    "ssh_control_persist": "30m",
+}
+
+
+class ModuleFailed(Exception):
+    """Raised by FakeModule.fail_json(), with its arguments."""
+
+
+class FakeModule(object):
+    """Stand in for AnsibleModule, to drive a VagrantClient in process."""
+
+    def __init__(self, params):
+        self.params = params
+        self.warnings = []
+
+    def warn(self, warning):
+        self.warnings.append(warning)
+
+    def fail_json(self, **kwargs):
+        raise ModuleFailed(kwargs)
+
+    def exit_json(self, **kwargs):
+        self.result = kwargs
+        raise SystemExit(0)
+
+
+@pytest.fixture
+def make_client(fake_vagrant_env, monkeypatch):
+    """Return a function creating a VagrantClient in the current process.
+
+    Its methods can be called one by one, the Vagrant processes they start
+    run fake_vagrant.py.
+    """
+    from molecule_vagrant.modules.vagrant import VagrantClient
+
+    for name, value in fake_vagrant_env.items():
+        monkeypatch.setenv(name, value)
+
+    def make(instances, **params):
+        module = FakeModule(
+            dict(
+                MODULE_PARAMS,
+                instances=instances,
+                default_box="generic/alpine316",
+                workdir=fake_vagrant_env["MOLECULE_EPHEMERAL_DIRECTORY"],
+                **params
+            )
+        )
+        return VagrantClient(module)
+
+    return make
@@ -1,5 +1,195 @@
-from molecule import api
+import os
+import shutil
+import tempfile
+from types import SimpleNamespace
+
+import pytest
+import yaml
+from molecule import api, config
+
+from molecule_vagrant.driver import Vagrant
 
 
 def test_driver_is_detected():
     assert "vagrant" in [str(d) for d in api.drivers()]
+
+
+def test_instance_config_cache(tmp_path):
+    instance_config = tmp_path / "instance_config.yml"
+    config = SimpleNamespace(driver=SimpleNamespace(instance_config=instance_config))
+    driver = Vagrant(config)
+
+    with pytest.raises(IOError):
+        driver._get_instance_config("instance-1")
+
+    instance_config.write_text("- instance: instance-1\n  address: 192.168.0.1\n")
+    assert driver._get_instance_config("instance-1")["address"] == "192.168.0.1"
+    with pytest.raises(StopIteration):
+        driver._get_instance_config("instance-2")
+
+    instance_config.write_text(
+        "- instance: instance-1\n  address: 192.168.0.10\n"
+        "- instance: instance-2\n  address: 192.168.0.2\n"
+    )
+    assert driver._get_instance_config("instance-1")["address"] == "192.168.0.10"
+    assert driver._get_instance_config("instance-2")["address"] == "192.168.0.2"
+
+
+def _molecule_config(
+    tmp_path, monkeypatch, ephemeral_directory=None, molecule_yml=None, **driver
+):
+    """Return the Molecule config of a scenario using the vagrant driver."""
+    if molecule_yml is None:
+        molecule_yml = yaml.safe_dump(
+            {
+                "driver": dict(name="vagrant", **driver),
+                "platforms": [{"name": "instance-1"}],
+            }
+        )
+    scenario = tmp_path / "project" / "molecule" / "default"
+    scenario.mkdir(parents=True)
+    (scenario / "molecule.yml").write_text(molecule_yml)
+    monkeypatch.chdir(tmp_path / "project")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    if ephemeral_directory is None:
+        monkeypatch.delenv("MOLECULE_EPHEMERAL_DIRECTORY", raising=False)
+    else:
+        monkeypatch.setenv("MOLECULE_EPHEMERAL_DIRECTORY", ephemeral_directory)
+    return config.Config(
+        "molecule/default/molecule.yml",
+        args={},
+        command_args={"subcommand": "destroy"},
+    )
+
+
+def _prune(c, files):
+    """Create files in the ephemeral directory, prune it, return what's left."""
+    for f in files:
+        path = os.path.join(c.scenario.ephemeral_directory, f)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w"):
+            pass
+    c.scenario.prune()
+    return [
+        f
+        for f in files
+        if os.path.exists(os.path.join(c.scenario.ephemeral_directory, f))
+    ]
+
+
+def test_prune_keeps_vagrant_state(tmp_path, monkeypatch):
+    # Instances restored to their snapshot or suspended on destroy are found
+    # again by Vagrant on the next create through .vagrant.
+    kept = [
+        "Vagrantfile",
+        "Vagrantfile.sha256",
+        ".vagrant/machines/instance-1/virtualbox/id",
+        ".vagrant/machines/instance-1/virtualbox/index_uuid",
+        ".vagrant/rgloader/loader.rb",
+        "instance_config.yml",
+        "vagrant-snapshots.json",
+        "vagrant-instances.json",
+        "vagrant-instance-1.out",
+        "ssh/127.0.0.1-2222-vagrant",
+        "vagrantfile-cache/fragments.json",
+        "vagrantfile-cache/bytecode/__jinja2_0123.cache",
+    ]
+    c = _molecule_config(tmp_path, monkeypatch)
+
+    assert _prune(c, kept + ["vagrant.out", "timings.json"]) == kept
+
+
+def test_prune_keeps_vagrant_shards(tmp_path, monkeypatch):
+    kept = [
+        "vagrant-shards/instance-1/Vagrantfile",
+        "vagrant-shards/instance-1/Vagrantfile.sha256",
+        "vagrant-shards/instance-1/.vagrant/machines/instance-1/virtualbox/id",
+        "instance_config.yml",
+    ]
+    c = _molecule_config(tmp_path, monkeypatch, provider={"layout": "sharded"})
+
+    assert _prune(c, kept + ["Vagrantfile", "vagrant.out"]) == kept
+
+
+def test_suspended_instances_resume_after_prune(
+    tmp_path, monkeypatch, fake_vagrant_env, run_module
+):
+    # Instances suspended on destroy are resumed by the next create, even
+    # though Molecule pruned the ephemeral directory in between.
+    args = {
+        "instances": [{"name": "instance-1"}],
+        "default_box": "molecule/fake",
+        "provider_name": "fake",
+    }
+    result = run_module(state="up", **args)
+    assert result["outcomes"][0]["outcome"] == "started"
+    assert run_module(state="suspend", **args)["suspended"] == ["instance-1"]
+
+    c = _molecule_config(
+        tmp_path,
+        monkeypatch,
+        ephemeral_directory=fake_vagrant_env["MOLECULE_EPHEMERAL_DIRECTORY"],
+    )
+    c.scenario.prune()
+
+    result = run_module(state="up", **args)
+    assert result["outcomes"][0]["outcome"] == "resumed"
+
+
+def _get_readme_example(title):
+    """Return the code block following title in README.rst."""
+    with open(os.path.join(os.path.dirname(__file__), "..", "..", "README.rst")) as f:
+        lines = f.read().split(title, 1)[1].splitlines()[1:]
+    block = []
+    for line in lines[lines.index(".. code-block:: yaml") + 1 :]:
+        if line and not line.startswith(" "):
+            break
+        block.append(line)
+    return "\n".join(block)
+
+
+def test_readme_options_are_accepted(tmp_path, monkeypatch):
+    # Every option of the full example passes Molecule's schema validation
+    # and reaches the driver.
+    c = _molecule_config(
+        tmp_path,
+        monkeypatch,
+        molecule_yml=_get_readme_example("Here's a full example"),
+    )
+
+    assert c.driver.layout == "single"
+    assert c.driver._get_option("max_workers", None) == 1
+    assert c.driver._get_option("ssh_control_persist", None) == "30m"
+
+
+def test_ssh_control_directory_is_created(tmp_path, monkeypatch):
+    # Scenarios with their own create playbook never start the masters,
+    # ssh must still find the directory to bind its control socket in.
+    ephemeral_directory = tempfile.mkdtemp(prefix="mv-")
+    try:
+        c = _molecule_config(
+            tmp_path, monkeypatch, ephemeral_directory=ephemeral_directory
+        )
+        with open(c.driver.instance_config, "w") as f:
+            yaml.safe_dump(
+                [
+                    {
+                        "instance": "instance-1",
+                        "address": "127.0.0.1",
+                        "port": 2222,
+                        "user": "vagrant",
+                        "identity_file": "/tmp/private_key",
+                    }
+                ],
+                f,
+            )
+        assert not os.path.exists(c.driver.ssh_control_directory)
+
+        options = c.driver.ansible_connection_options("instance-1")
+
+        assert "-o ControlPath={}/%h-%p-%r".format(c.driver.ssh_control_directory) in (
+            options["ansible_ssh_common_args"]
+        )
+        assert os.path.isdir(c.driver.ssh_control_directory)
+    finally:
+        shutil.rmtree(ephemeral_directory)
@@ -0,0 +1,813 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import pytest
+
+from molecule_vagrant.modules.vagrant import BootSlotTimeout, VagrantfileRenderer
+
+IMPORT_TIME = """
+import json, sys, time
+
+start = time.perf_counter()
+import ansible.module_utils.basic, vagrant
+dependencies = time.perf_counter() - start
+
+start = time.perf_counter()
+import molecule_vagrant.modules.vagrant
+module = time.perf_counter() - start
+
+print(json.dumps({
+    "dependencies": dependencies,
+    "module": module,
+    "modules": sorted(sys.modules),
+}))
+"""
+
+
+def test_module_startup():
+    # The module is started in a new Python process by every task using it.
+    # Importing it must not drag Molecule or jinja2 along, and must cost less
+    # than the dependencies it can't do without (it was ~7 times more when it
+    # imported molecule.util).
+    output = subprocess.check_output(
+        [sys.executable, "-c", IMPORT_TIME], stderr=subprocess.DEVNULL
+    )
+    result = json.loads(output)
+
+    assert "molecule" not in result["modules"]
+    assert "jinja2" not in result["modules"]
+    assert result["module"] < result["dependencies"]
+
+
+def _instance(index):
+    return {
+        "name": "instance-{}".format(index),
+        "box": "generic/alpine316",
+        "box_version": None,
+        "box_url": None,
+        "box_download_checksum": None,
+        "box_download_checksum_type": None,
+        "config_options": {"synced_folder": False},
+        "hostname": None,
+        "networks": [
+            {"name": "private_network", "options": {"ip": "10.0.0.{}".format(index)}}
+        ],
+        "instance_raw_config_args": None,
+        "provider": "virtualbox",
+        "memory": 512,
+        "cpus": 2,
+        "provider_options": {},
+        "provider_raw_config_args": None,
+        "provider_override_args": None,
+    }
+
+
+def test_vagrantfile_render_cache(tmp_path):
+    # Only the platforms which changed are rendered again, whatever the
+    # number of instances: the other blocks come from the fragment cache.
+    cache_dir = str(tmp_path / "cache")
+    instances = [_instance(i) for i in range(20)]
+
+    renderer = VagrantfileRenderer(cache_dir)
+    vagrantfile = renderer.render(instances, "machine", False)
+    assert renderer.stats == {"rendered": 20, "reused": 0}
+
+    renderer = VagrantfileRenderer(cache_dir)
+    assert renderer.render(instances, "machine", False) == vagrantfile
+    assert renderer.stats == {"rendered": 0, "reused": 20}
+
+    instances[0]["memory"] = 1024
+    instances[7]["cpus"] = 4
+    renderer = VagrantfileRenderer(cache_dir)
+    updated = renderer.render(instances, "machine", False)
+    assert renderer.stats == {"rendered": 2, "reused": 18}
+    assert updated != vagrantfile
+    assert updated == VagrantfileRenderer(str(tmp_path / "cold")).render(
+        instances, "machine", False
+    )
+
+    # The same instance listed twice is only rendered once.
+    renderer = VagrantfileRenderer(str(tmp_path / "twice"))
+    renderer.render([instances[0], instances[0]], "machine", False)
+    assert renderer.stats == {"rendered": 1, "reused": 0}
+
+
+SSH_CONFIG = """Host instance-1
+  HostName 127.0.0.1
+  User vagrant
+  Port 2222
+  UserKnownHostsFile /dev/null
+  IdentityFile /tmp/instance-1/private_key
+
+Host instance-2
+  HostName 127.0.0.1
+  User vagrant
+  Port 2200
+  UserKnownHostsFile /dev/null
+  IdentityFile /tmp/instance-2/private_key
+"""
+
+
+def test_conf_all(make_client, monkeypatch):
+    # One `vagrant ssh-config` gives the configuration of every instance.
+    client = make_client([_instance(1), _instance(2)])
+    monkeypatch.setattr(client._vagrant, "ssh_config", lambda: SSH_CONFIG)
+
+    confs = client._conf_all()
+
+    assert sorted(confs) == ["instance-1", "instance-2"]
+    assert confs["instance-2"]["Host"] == "instance-2"
+    assert confs["instance-2"]["Port"] == "2200"
+    assert confs["instance-2"]["IdentityFile"] == "/tmp/instance-2/private_key"
+
+
+def _ssh_conf(index, **conf):
+    return dict(
+        {
+            "Host": "instance-{}".format(index),
+            "HostName": "127.0.0.1",
+            "Port": str(2200 + index),
+            "User": "vagrant",
+            "IdentityFile": "/tmp/instance-{}/private_key".format(index),
+        },
+        **conf
+    )
+
+
+@pytest.fixture
+def short_tmp_path():
+    """Return a directory short enough to hold ssh control sockets."""
+    path = tempfile.mkdtemp(prefix="mv-")
+    yield path
+    shutil.rmtree(path)
+
+
+def test_start_ssh_masters(make_client, monkeypatch, short_tmp_path):
+    # instance-1 has no master yet, instance-2 has one running, the master
+    # of instance-3 fails to start and the socket of instance-4 would not
+    # fit in a sockaddr_un.
+    client = make_client([_instance(i) for i in range(1, 5)])
+    control_dir = os.path.join(short_tmp_path, "ssh")
+    monkeypatch.setattr(client, "_get_ssh_control_dir", lambda: control_dir)
+    commands = []
+
+    def run_ssh(cmd):
+        commands.append(cmd)
+        port = cmd[cmd.index("-p") + 1]
+        if "check" in cmd:
+            return port == "2202"
+        return port == "2201"
+
+    monkeypatch.setattr(client, "_run_ssh", run_ssh)
+
+    result = client._start_ssh_masters(
+        [_ssh_conf(1), _ssh_conf(2), _ssh_conf(3), _ssh_conf(4, User="u" * 100)]
+    )
+
+    assert result == {"started": ["instance-1"], "failed": ["instance-3", "instance-4"]}
+    started = [c for c in commands if "-N" in c]
+    assert [c[c.index("-p") + 1] for c in started] == ["2201", "2203"]
+    assert "ControlPersist=30m" in started[0]
+    assert "/tmp/instance-1/private_key" in started[0]
+    assert "ControlPath={}/%h-%p-%r".format(control_dir) in started[0]
+    assert os.stat(control_dir).st_mode & 0o777 == 0o700
+
+
+def test_prepared_index_lock(make_client, monkeypatch, tmp_path):
+    # A run reading the index while another one packages a box must wait
+    # for it to be written, not write back the index without the new box.
+    import fcntl
+
+    monkeypatch.setenv("VAGRANT_HOME", str(tmp_path / "vagrant.d"))
+    make_client([_instance(1)], prepared_boxes=True)
+    index = tmp_path / "vagrant.d" / "molecule-prepared-boxes" / "index.json"
+    entry = {"box": "molecule-prepared-0", "size": 1, "last_used": 0}
+
+    with open(str(index) + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        thread = threading.Thread(
+            target=make_client, args=([_instance(1)],), kwargs={"prepared_boxes": True}
+        )
+        thread.start()
+        thread.join(0.5)
+        assert thread.is_alive()
+        index.write_text(json.dumps({"0" * 64: entry}))
+
+    thread.join()
+    assert json.loads(index.read_text()) == {"0" * 64: entry}
+
+
+def test_failed_prefetch_falls_back_to_up(fake_vagrant_env, run_module, tmp_path):
+    # Boxes which can't be listed nor added are left to `vagrant up`.
+    fake_vagrant_env["FAKE_VAGRANT_FAIL"] = "box"
+    fake_vagrant_env["VAGRANT_HOME"] = str(tmp_path / "vagrant.d")
+
+    result = run_module(
+        state="up",
+        instances=[{"name": "instance-1"}],
+        default_box="molecule/fake",
+        provider_name="fake",
+        prefetch_boxes=True,
+    )
+
+    assert not result.get("failed"), result.get("msg")
+    assert result["prefetch"] == {
+        "present": [],
+        "added": [],
+        "failed": ["molecule/fake||fake"],
+    }
+    assert result["outcomes"][0]["outcome"] == "started"
+
+
+def test_timings_of_pooled_commands(run_module):
+    # Each Vagrant process started from the worker pool is recorded with the
+    # phase it ran for and its command.
+    result = run_module(
+        state="up",
+        instances=[{"name": "instance-{}".format(i)} for i in range(3)],
+        default_box="molecule/fake",
+        provider_name="fake",
+        max_workers=3,
+    )
+
+    commands = [(c["phase"], c["command"]) for c in result["timings"]["commands"]]
+    assert commands == [
+        ("validate", "validate"),
+        ("up", "up"),
+        ("up", "up"),
+        ("up", "up"),
+        ("status", "status"),
+        ("conf", "ssh-config"),
+    ]
+
+
+def test_timed_phases_are_per_thread(make_client):
+    # Threads timing different phases at the same time don't mix them up.
+    client = make_client([_instance(1)])
+    barrier = threading.Barrier(2)
+
+    def run(phase):
+        with client._timed(phase):
+            barrier.wait()
+            with client._timed_command(phase + "-command"):
+                barrier.wait()
+
+    threads = [threading.Thread(target=run, args=(p,)) for p in ("up", "halt")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    commands = client._timings["commands"][-2:]
+    assert sorted((c["phase"], c["command"]) for c in commands) == [
+        ("halt", "halt-command"),
+        ("up", "up-command"),
+    ]
+
+
+def test_read_log_of_the_run(make_client):
+    # A log grown past log_max_size is rotated, and errors only report what
+    # the current run wrote.
+    client = make_client([_instance(1)], log_max_size=1024)
+    log = client._get_stderr_log()
+    with open(log, "w") as f:
+        f.write("previous run\n" * 100)
+
+    with client._open_log(log) as fh:
+        fh.write("current run\n")
+
+    assert client._read_log(log).endswith("###\ncurrent run\n")
+    assert "previous run" not in client._read_log(log)
+    assert open(log + ".1").read() == "previous run\n" * 100
+
+
+def test_config_changes(make_client):
+    make_client([_instance(1), _instance(2), _instance(3)])._write_instances_config()
+    instances = [_instance(1), _instance(2), _instance(3)]
+    instances[1]["memory"] = 1024
+    instances[2]["box"] = "generic/alpine317"
+    client = make_client(instances)
+
+    assert client._get_config_changes(
+        {
+            "instance-1": {"state": "running"},
+            "instance-2": {"state": "running"},
+            "instance-3": {"state": "running"},
+        }
+    ) == [
+        {"name": "instance-2", "action": "reload", "keys": ["memory"]},
+        {"name": "instance-3", "action": "recreate", "keys": ["box"]},
+    ]
+    # Stopped instances get the change when started, instances not created
+    # have none to apply.
+    assert client._get_config_changes(
+        {
+            "instance-1": {"state": "poweroff"},
+            "instance-2": {"state": "poweroff"},
+            "instance-3": {"state": "not_created"},
+        }
+    ) == [{"name": "instance-2", "action": "up", "keys": ["memory"]}]
+
+
+def test_config_changes_of_prepared_box(make_client, monkeypatch, tmp_path):
+    # An instance created from its base box and later from its prepared box
+    # has the same config, the prepared box standing in for the base one.
+    vagrant_home = tmp_path / "vagrant.d"
+    monkeypatch.setenv("VAGRANT_HOME", str(vagrant_home))
+    client = make_client([_instance(1)], prepared_boxes=True)
+    client._write_instances_config()
+    key = client._prepared_keys["instance-1"]
+    boxes = vagrant_home / "molecule-prepared-boxes"
+    (boxes / (key + ".box")).write_text("box")
+    (boxes / "index.json").write_text(
+        json.dumps({key: {"box": "molecule-prepared-0", "size": 3, "last_used": 0}})
+    )
+
+    client = make_client([_instance(1)], prepared_boxes=True)
+
+    assert client._instances_config["instance-1"]["box"] == "molecule-prepared-0"
+    assert client._get_config_changes({"instance-1": {"state": "running"}}) == []
+
+
+def test_admit(make_client, monkeypatch):
+    # Instances of 512 MiB and 2 CPUs on a host of 4 CPUs: the first wave
+    # is bound by both the memory and the CPUs, the last instance fits in
+    # no wave and is forced.
+    names = ["instance-1", "instance-2", "instance-3"]
+    client = make_client([_instance(i) for i in range(1, 4)], admission=True)
+    available = iter([1024 + 1536, 1024 + 256])
+    monkeypatch.setattr(client, "_get_memory_available", lambda: next(available))
+    monkeypatch.setattr(os, "cpu_count", lambda: 4)
+
+    assert list(client._admit(names)) == [names[:2], names[2:]]
+    assert client.result["admission"] == {
+        "cpus": 4.0,
+        "waves": [
+            {
+                "instances": names[:2],
+                "memory": 1024,
+                "cpus": 4,
+                "memory_available": 2560,
+                "forced": False,
+            },
+            {
+                "instances": names[2:],
+                "memory": 512,
+                "cpus": 2,
+                "memory_available": 1280,
+                "forced": True,
+            },
+        ],
+    }
+
+
+def test_admit_without_memory_available(make_client, monkeypatch):
+    # Everything is started at once when the memory available is unknown,
+    # like when admission is disabled.
+    names = ["instance-1", "instance-2", "instance-3"]
+    client = make_client([_instance(i) for i in range(1, 4)], admission=True)
+    monkeypatch.setattr(client, "_get_memory_available", lambda: None)
+
+    assert list(client._admit(names)) == [names]
+    assert list(make_client([_instance(1)])._admit(names)) == [names]
+
+
+def _lock_slot(slots_dir, slot):
+    """Take a boot slot like another module run would, None if it can't."""
+    import fcntl
+
+    fh = open(os.path.join(slots_dir, "slot-{}.lock".format(slot)), "a")
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fh.close()
+        return None
+    return fh
+
+
+def test_boot_slots(make_client, monkeypatch, tmp_path):
+    monkeypatch.setattr("molecule_vagrant.modules.vagrant.BOOT_SLOT_POLL", 0.01)
+    slots_dir = str(tmp_path / "slots")
+    client = make_client(
+        [_instance(1), _instance(2)], boot_slots=2, boot_slots_dir=slots_dir
+    )
+
+    with client._boot_slots(["instance-1"]):
+        held = [_lock_slot(slots_dir, slot) for slot in range(2)]
+        assert len([fh for fh in held if fh is None]) == 1
+        for fh in held:
+            if fh is not None:
+                fh.close()
+
+    # The slot is released once the instance started, another run taking
+    # it makes the next start wait for it.
+    other = _lock_slot(slots_dir, 0)
+    assert other is not None
+    threading.Timer(0.2, other.close).start()
+    with client._boot_slots(["instance-1", "instance-2"]):
+        assert _lock_slot(slots_dir, 0) is None
+        assert _lock_slot(slots_dir, 1) is None
+
+    waits = client.result["boot_slots"]
+    assert [w["instances"] for w in waits] == [
+        ["instance-1"],
+        ["instance-1", "instance-2"],
+    ]
+    assert waits[1]["wait"] >= 0.2
+
+
+def test_boot_slots_timeout(make_client, monkeypatch, tmp_path):
+    # Slots are taken all at once or none: waiting for two of them while
+    # another run holds one leaves the other free.
+    monkeypatch.setattr("molecule_vagrant.modules.vagrant.BOOT_SLOT_POLL", 0.01)
+    slots_dir = str(tmp_path / "slots")
+    client = make_client(
+        [_instance(1), _instance(2)],
+        boot_slots=2,
+        boot_slots_dir=slots_dir,
+        boot_slots_timeout=0,
+    )
+    os.makedirs(slots_dir)
+    other = _lock_slot(slots_dir, 0)
+
+    with pytest.raises(BootSlotTimeout):
+        with client._boot_slots(["instance-1", "instance-2"]):
+            pass
+
+    free = _lock_slot(slots_dir, 1)
+    assert free is not None
+    free.close()
+    other.close()
+
+
+def test_progress_events(make_client):
+    # Box downloads only report a change of percentage, other lines than
+    # phases and downloads are ignored.
+    client = make_client([_instance(1)])
+    lines = [
+        "Bringing machine 'instance-1' up with 'virtualbox' provider...\n",
+        "==> instance-1: Box 'generic/alpine316' could not be found.\n",
+        "    instance-1: Progress: 0% (Rate: 0/s, Estimated time remaining: --:--:--)\n",
+        "    instance-1: Progress: 0% (Rate: 1M/s, Estimated time remaining: 0:01:00)\n",
+        "    instance-2: Progress: 0% (Rate: 1M/s, Estimated time remaining: 0:01:00)\n",
+        "    instance-1: Progress: 42% (Rate: 10M/s, Estimated time remaining: 0:00:30)\n",
+        "    instance-1: SSH address: 127.0.0.1:2222\n",
+        "==> instance-1: Booting VM...  \n",
+    ]
+
+    assert list(client._progress_events(lines)) == [
+        {
+            "machine": "instance-1",
+            "event": "phase",
+            "message": "Box 'generic/alpine316' could not be found.",
+        },
+        {"machine": "instance-1", "event": "download", "percent": 0},
+        {"machine": "instance-2", "event": "download", "percent": 0},
+        {"machine": "instance-1", "event": "download", "percent": 42},
+        {"machine": "instance-1", "event": "phase", "message": "Booting VM..."},
+    ]
+
+
+def _fake_probe(outputs):
+    """Return a _run_probe answering from outputs, failing for other commands."""
+    return lambda cmd: outputs.get(" ".join(cmd))
+
+
+def test_probe_virtualbox(make_client, monkeypatch):
+    # A state which may change without Vagrant knowing is left to it.
+    client = make_client([_instance(1)])
+    outputs = {
+        "VBoxManage list runningvms": '"instance-1" {id-1}\n',
+        "VBoxManage showvminfo id-2 --machine-readable": 'VMState="poweroff"\n',
+        "VBoxManage showvminfo id-3 --machine-readable": 'VMState="saved"\n',
+        "VBoxManage showvminfo id-4 --machine-readable": 'VMState="aborted"\n',
+        "VBoxManage showvminfo id-5 --machine-readable": 'VMState="starting"\n',
+    }
+    monkeypatch.setattr(client, "_run_probe", _fake_probe(outputs))
+
+    ids = ["id-1", "id-2", "id-3", "id-4", "id-5", "id-6"]
+    assert client._probe_virtualbox(ids) == {
+        "id-1": "running",
+        "id-2": "poweroff",
+        "id-3": "saved",
+        "id-4": "aborted",
+    }
+
+    del outputs["VBoxManage list runningvms"]
+    assert client._probe_virtualbox(ids) is None
+
+
+def test_probe_libvirt(make_client, monkeypatch):
+    client = make_client([_instance(1)])
+    virsh = "virsh --connect qemu:///system "
+    outputs = {
+        virsh + "list --uuid": "uuid-1\n\n",
+        virsh + "domstate uuid-2": "shut off\n\n",
+        virsh + "domstate uuid-3": "paused\n\n",
+        virsh + "domstate uuid-4": "in shutdown\n\n",
+    }
+    monkeypatch.setattr(client, "_run_probe", _fake_probe(outputs))
+
+    ids = ["uuid-1", "uuid-2", "uuid-3", "uuid-4", "uuid-5"]
+    assert client._probe_libvirt(ids) == {
+        "uuid-1": "running",
+        "uuid-2": "poweroff",
+        "uuid-3": "saved",
+    }
+
+    # Instances spread over several libvirt connections are left to Vagrant.
+    instance = _instance(2)
+    instance["provider_options"] = {"uri": "qemu+ssh://host/system"}
+    client = make_client([_instance(1), instance])
+    monkeypatch.setattr(client, "_run_probe", _fake_probe(outputs))
+    assert client._probe_libvirt(ids) is None
+
+
+def test_probe_status(make_client, monkeypatch, fake_vagrant_env):
+    # Machines without an id are not created, the others get the state
+    # probed, and a single unknown state leaves it all to `vagrant status`.
+    client = make_client([_instance(i) for i in range(1, 4)])
+    workdir = fake_vagrant_env["MOLECULE_EPHEMERAL_DIRECTORY"]
+    for i in (1, 2):
+        id_file = os.path.join(
+            workdir, ".vagrant", "machines", "instance-{}".format(i), "virtualbox", "id"
+        )
+        os.makedirs(os.path.dirname(id_file))
+        with open(id_file, "w") as f:
+            f.write("id-{}\n".format(i))
+    outputs = {
+        "VBoxManage list runningvms": '"instance-1" {id-1}\n',
+        "VBoxManage showvminfo id-2 --machine-readable": 'VMState="saved"\n',
+    }
+    monkeypatch.setattr(client, "_run_probe", _fake_probe(outputs))
+
+    assert client._probe_status() == {
+        "instance-1": {
+            "name": "instance-1",
+            "state": "running",
+            "provider": "virtualbox",
+        },
+        "instance-2": {
+            "name": "instance-2",
+            "state": "saved",
+            "provider": "virtualbox",
+        },
+        "instance-3": {
+            "name": "instance-3",
+            "state": "not_created",
+            "provider": "virtualbox",
+        },
+    }
+
+    outputs["VBoxManage showvminfo id-2 --machine-readable"] = 'VMState="paused"\n'
+    assert client._probe_status() is None
+
+
+def test_split_log(make_client):
+    # Instances started by a single Vagrant process share its stderr, each
+    # failed instance only reports the lines about itself or none of them.
+    client = make_client([_instance(1), _instance(2)])
+    log = (
+        "### 2024-01-01 00:00:00 ###\n"
+        "==> instance-1: Box 'generic/alpine316' could not be found.\n"
+        "    instance-1: Downloading: generic/alpine316\n"
+        "==> instance-2: Booting VM...\n"
+        "An error occurred while downloading the remote file.\n"
+    )
+
+    assert client._split_log(log, ["instance-1", "instance-2"]) == {
+        "instance-1": (
+            "### 2024-01-01 00:00:00 ###\n"
+            "==> instance-1: Box 'generic/alpine316' could not be found.\n"
+            "    instance-1: Downloading: generic/alpine316\n"
+            "An error occurred while downloading the remote file.\n"
+        ),
+        "instance-2": (
+            "### 2024-01-01 00:00:00 ###\n"
+            "==> instance-2: Booting VM...\n"
+            "An error occurred while downloading the remote file.\n"
+        ),
+    }
+
+
+def _fake_args(count, **args):
+    return dict(
+        instances=[{"name": "instance-{}".format(i)} for i in range(1, count + 1)],
+        default_box="molecule/fake",
+        provider_name="fake",
+        **args
+    )
+
+
+def _read_snapshots(fake_vagrant_env):
+    path = os.path.join(
+        fake_vagrant_env["MOLECULE_EPHEMERAL_DIRECTORY"], "vagrant-snapshots.json"
+    )
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_snapshot_restore(run_module, fake_vagrant_env, max_workers):
+    args = _fake_args(2, max_workers=max_workers)
+    run_module(state="up", **args)
+
+    result = run_module(state="snapshot", **args)
+    assert result["changed"]
+    assert sorted(result["snapshots"]) == ["instance-1", "instance-2"]
+    assert _read_snapshots(fake_vagrant_env) == {
+        "instance-1": "molecule",
+        "instance-2": "molecule",
+    }
+    # Snapshots already taken are not taken again.
+    assert not run_module(state="snapshot", **args)["changed"]
+
+    run_module(state="halt", **args)
+    result = run_module(state="restore", **args)
+    assert sorted(result["restored"]) == ["instance-1", "instance-2"]
+    assert result["destroyed"] == []
+    result = run_module(state="up", **args)
+    assert [o["outcome"] for o in result["outcomes"]] == ["already_running"] * 2
+
+
+def test_restore_without_snapshot(run_module, fake_vagrant_env):
+    # Instances created after the snapshot have nothing to go back to, they
+    # are destroyed.
+    run_module(state="up", **_fake_args(1))
+    run_module(state="snapshot", **_fake_args(1))
+    args = _fake_args(2)
+    run_module(state="up", **args)
+
+    result = run_module(state="restore", **args)
+
+    assert result["restored"] == ["instance-1"]
+    assert result["destroyed"] == ["instance-2"]
+    result = run_module(state="up", **args)
+    assert [o["outcome"] for o in result["outcomes"]] == ["already_running", "started"]
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_failed_snapshot(run_module, fake_vagrant_env, max_workers):
+    args = _fake_args(2, max_workers=max_workers)
+    run_module(state="up", **args)
+    fake_vagrant_env["FAKE_VAGRANT_FAIL"] = "snapshot"
+
+    result = run_module(state="snapshot", **args)
+
+    assert result["failed"]
+    assert result["msg"].startswith("Failed to snapshot the VM(s)")
+    if max_workers == 1:
+        assert "The snapshot command failed." in result["stderr"]
+    else:
+        assert sorted(result["errors"]) == ["instance-1", "instance-2"]
+    assert _read_snapshots(fake_vagrant_env) == {}
+
+    # Without a snapshot taken, restoring destroys the instances.
+    fake_vagrant_env["FAKE_VAGRANT_FAIL"] = ""
+    result = run_module(state="restore", **args)
+    assert result["restored"] == []
+    assert sorted(result["destroyed"]) == ["instance-1", "instance-2"]
+
+
+def _exit(client, action):
+    """Run a module action of client, returning its result."""
+    with pytest.raises(SystemExit):
+        getattr(client, action)()
+    return client._module.result
+
+
+def _prepared_client(make_client, boxes, budget):
+    return make_client(
+        [{"name": "instance-{}".format(box), "box": box} for box in boxes],
+        provider_name="fake",
+        prepared_boxes=True,
+        prepared_boxes_budget=budget,
+    )
+
+
+def test_package_and_evict(make_client, monkeypatch, tmp_path):
+    # Prepared boxes of 1024 bytes, with room for two of them: box-a, used
+    # again by an up, is kept while box-b, the least recently used, goes.
+    vagrant_home = tmp_path / "vagrant.d"
+    monkeypatch.setenv("VAGRANT_HOME", str(vagrant_home))
+    index_file = vagrant_home / "molecule-prepared-boxes" / "index.json"
+    budget = 2 * 1024 + 512
+
+    client = _prepared_client(make_client, ["box-a", "box-b"], budget)
+    keys = dict((n[9:], k) for n, k in client._prepared_keys.items())
+    _exit(client, "up")
+    result = _exit(_prepared_client(make_client, ["box-a", "box-b"], budget), "package")
+    assert result["prepared"] == {
+        "packaged": ["instance-box-a", "instance-box-b"],
+        "failed": [],
+        "evicted": [],
+    }
+    assert sorted(json.loads(index_file.read_text())) == sorted(keys.values())
+
+    client = _prepared_client(make_client, ["box-a"], budget)
+    assert client._instances_config["instance-box-a"]["box"] == (
+        "molecule-prepared-" + keys["box-a"][:16]
+    )
+    client = _prepared_client(make_client, ["box-c"], budget)
+    keys["box-c"] = client._prepared_keys["instance-box-c"]
+    _exit(client, "up")
+    result = _exit(_prepared_client(make_client, ["box-c"], budget), "package")
+
+    assert result["prepared"] == {
+        "packaged": ["instance-box-c"],
+        "failed": [],
+        "evicted": ["molecule-prepared-" + keys["box-b"][:16]],
+    }
+    index = json.loads(index_file.read_text())
+    assert sorted(index) == sorted([keys["box-a"], keys["box-c"]])
+    assert index[keys["box-c"]]["size"] == 1024
+    assert sorted(os.listdir(index_file.parent)) == sorted(
+        [
+            "index.json",
+            "index.json.lock",
+            keys["box-a"] + ".box",
+            keys["box-c"] + ".box",
+        ]
+    )
+
+
+def test_up_from_prepared_box(make_client, monkeypatch, tmp_path, fake_vagrant_env):
+    # Once packaged, new instances of the same box boot from the prepared
+    # one, but are recorded with their base box.
+    monkeypatch.setenv("VAGRANT_HOME", str(tmp_path / "vagrant.d"))
+    client = _prepared_client(make_client, ["box-a"], 10 * 1024)
+    key = client._prepared_keys["instance-box-a"]
+    _exit(client, "up")
+    _exit(_prepared_client(make_client, ["box-a"], 10 * 1024), "package")
+    _exit(_prepared_client(make_client, ["box-a"], 10 * 1024), "destroy")
+
+    result = _exit(_prepared_client(make_client, ["box-a"], 10 * 1024), "up")
+
+    assert result["outcomes"][0]["outcome"] == "started"
+    workdir = fake_vagrant_env["MOLECULE_EPHEMERAL_DIRECTORY"]
+    with open(os.path.join(workdir, "Vagrantfile")) as f:
+        vagrantfile = f.read()
+    assert '"molecule-prepared-{}"'.format(key[:16]) in vagrantfile
+    assert (
+        "file://{}".format(
+            tmp_path / "vagrant.d" / "molecule-prepared-boxes" / (key + ".box")
+        )
+        in vagrantfile
+    )
+    with open(os.path.join(workdir, "vagrant-instances.json")) as f:
+        assert json.load(f)["instance-box-a"]["box"] == "box-a"
+
+
+def test_failed_pooled_up(run_module, fake_vagrant_env):
+    # Instances started from the worker pool log to their own files, which
+    # the failure points to.
+    fake_vagrant_env["FAKE_VAGRANT_FAIL"] = "up"
+    workdir = fake_vagrant_env["MOLECULE_EPHEMERAL_DIRECTORY"]
+
+    result = run_module(state="up", **_fake_args(2, max_workers=2))
+
+    assert result["failed"]
+    assert result["msg"] == (
+        "Failed to start the VM(s) instance-1, instance-2: See log files "
+        "'{0}/vagrant-instance-1.err', '{0}/vagrant-instance-2.err'".format(workdir)
+    )
+    assert result["stderr"] == "".join(o["stderr"] for o in result["outcomes"])
+    for outcome in result["outcomes"]:
+        assert outcome["stderr"].endswith("###\nThe up command failed.\n")
+
+
+def test_progress_log_rotation(make_client):
+    # The progress log is rotated like the other logs.
+    client = make_client([_instance(1)], log_max_size=1024, stream=True)
+    progress = client._get_vagrant_log("progress")
+    with open(progress, "w") as f:
+        f.write("{}\n" * 512)
+
+    client._emit_progress({"machine": "instance-1", "event": "download", "percent": 1})
+    client._emit_progress({"machine": "instance-1", "event": "download", "percent": 2})
+
+    with open(progress) as f:
+        assert [json.loads(line)["percent"] for line in f] == [1, 2]
+    with open(progress + ".1") as f:
+        assert f.read() == "{}\n" * 512
+
+
+def test_shards_save_fragments_once(make_client, monkeypatch):
+    # Every shard is rendered from the fragment cache, which is saved once
+    # with all their blocks.
+    saved = []
+    monkeypatch.setattr(
+        VagrantfileRenderer, "_write_fragments", lambda self, f: saved.append(dict(f))
+    )
+
+    client = make_client([_instance(i) for i in range(1, 4)], layout="sharded")
+
+    assert client.result["fragments"] == {"rendered": 3, "reused": 0}
+    assert [len(fragments) for fragments in saved] == [3]